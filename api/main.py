@@ -1,27 +1,39 @@
 import os 
+import re
+import csv
+import json
 import uvicorn
 import pandas as pd
 import time
+from io import StringIO
 from typing import Optional
+from contextlib import asynccontextmanager
 from dateutil.parser import parse
 from fastapi import FastAPI, HTTPException, Header, Depends, Request, Response
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 import asyncio
+import logging
 import aiomysql
 from dotenv import  load_dotenv, find_dotenv
-from influxdb_client import InfluxDBClient
-from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client import Dialect
+from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
 
 load_dotenv()
 
-app = FastAPI()
+logger = logging.getLogger("uvicorn.error")
 
 bucket = str(os.getenv('INFLUXDB_BUCKET'))
 org = str(os.getenv('INFLUXDB_ORG'))
 token = str(os.getenv('INFLUX_TOKEN'))
 url = str(os.getenv('INFLUXDB_HOST'))
 
-client = InfluxDBClient(url=url, token=token, org=org)
+# Flux queries run on one shared async client, a slow query never holds a thread
+INFLUX_QUERY_TIMEOUT = float(os.getenv('INFLUX_QUERY_TIMEOUT') or 30)
+INFLUX_POOL_SIZE = int(os.getenv('INFLUX_POOL_SIZE') or 100)
+# A streamed export reads its whole range off one response, the client timeout covers all of it
+INFLUX_STREAM_TIMEOUT = float(os.getenv('INFLUX_STREAM_TIMEOUT') or 600)
+# How often a running query checks whether its HTTP client is still there
+DISCONNECT_POLL = 0.5
 
 DB_CONFIG = {
     "host": str(os.getenv('MYSQL_HOST')),
@@ -30,99 +42,237 @@ DB_CONFIG = {
     "db": str(os.getenv('MYSQL_DB'))
 }
 
+# Connections of one worker process, uvicorn runs --workers of them
+DB_POOL_CONFIG = {
+    "minsize": int(os.getenv('API_MYSQL_POOL_MIN') or 1),
+    "maxsize": int(os.getenv('API_MYSQL_POOL_SIZE') or 10),
+    # Reconnect connections older than this, before MariaDB's wait_timeout drops them
+    "pool_recycle": int(os.getenv('API_MYSQL_POOL_RECYCLE') or 3600),
+}
+DB_ACQUIRE_TIMEOUT = float(os.getenv('API_MYSQL_POOL_TIMEOUT') or 5)
+
+# Time requests waited for a pooled connection
+pool_metrics = {"acquired": 0, "timeouts": 0, "wait_seconds_total": 0.0, "wait_seconds_max": 0.0}
+
+async def db_pool():
+    # created on first use, so the API starts and serves without POI metadata while MariaDB is down
+    async with app.state.db_pool_lock:
+        if app.state.db_pool is None:
+            # autocommit, so a reused connection never reads from an old snapshot
+            app.state.db_pool = await aiomysql.create_pool(autocommit=True, **DB_POOL_CONFIG, **DB_CONFIG)
+    return app.state.db_pool
+
+@asynccontextmanager
+async def lifespan(app):
+    app.state.db_pool = None
+    app.state.db_pool_lock = asyncio.Lock()
+    # the client timeout only backs up run_query's own
+    app.state.influx = InfluxDBClientAsync(url=url, token=token, org=org, timeout=int(INFLUX_QUERY_TIMEOUT * 1000) + 5000, connection_pool_maxsize=INFLUX_POOL_SIZE)
+    app.state.influx_stream = InfluxDBClientAsync(url=url, token=token, org=org, timeout=int(INFLUX_STREAM_TIMEOUT * 1000), connection_pool_maxsize=INFLUX_POOL_SIZE)
+    try:
+        # an unreachable MariaDB does not hold up the start either
+        await asyncio.wait_for(load_pois(), timeout=DB_ACQUIRE_TIMEOUT)
+    except Exception as e:
+        # the refresh task loads it as soon as MariaDB answers
+        logger.warning(f"POI cache load failed: {e}")
+    refresher = asyncio.create_task(keep_pois_fresh())
+    yield
+    refresher.cancel()
+    await app.state.influx.close()
+    await app.state.influx_stream.close()
+    if app.state.db_pool is not None:
+        app.state.db_pool.close()
+        await app.state.db_pool.wait_closed()
+
+app = FastAPI(lifespan=lifespan)
+
+@asynccontextmanager
 async def get_db():
-    conn = await aiomysql.connect(**DB_CONFIG)
-    return conn
+    # borrow a pooled connection, a request that waits too long gets a 503
+    pool = await db_pool()
+    wait_start = time.perf_counter()
+    try:
+        conn = await asyncio.wait_for(pool.acquire(), timeout=DB_ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError:
+        pool_metrics["timeouts"] += 1
+        raise HTTPException(status_code=503, detail="Database busy, try again later")
+    wait = time.perf_counter() - wait_start
+    pool_metrics["acquired"] += 1
+    pool_metrics["wait_seconds_total"] += wait
+    pool_metrics["wait_seconds_max"] = max(pool_metrics["wait_seconds_max"], wait)
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
 
-async def fetch_data_from_database(lat, lon):
-    conn = await get_db()
-    cur = await conn.cursor()
-    
-    query_city_id = """
-    SELECT city_id, added, started, horizon, last_hit 
-    FROM cities 
-    WHERE lat=%s AND lon=%s
-    """
-    await cur.execute(query_city_id, (lat, lon))
-    result = await cur.fetchone()
-    
-    if result is None:
-        await cur.close()
-        conn.close()
-        return {}
-    
-    city_id, added, started, horizon, last_hit = result
-
-    query_url = """
-    SELECT daily, hourly, icon, icon_15, gfs, meteofrance 
-    FROM query_urls 
-    WHERE city_id=%s
-    """
-    await cur.execute(query_url, (city_id,))
-    row = await cur.fetchone()
-    
-    await cur.close()
-    conn.close()
-    
-    if row is None:
-        return {
-            "added": added,
-            "started": started,
-            "horizon": horizon,
-            "last_hit": last_hit
-        }
-    
-    return {
-        "daily_forecast": row[0],
-        "hourly_forecast": row[1],
-        "icon_forecast": row[2],
-        "icon_15_forecast": row[3],
-        "gfs_forecast": row[4],
-        "meteofrance_forecast": row[5],
+# POI metadata by (lat, lon), so a query never waits for MariaDB. Loaded in bulk at startup,
+# then every POI_CACHE_POLL seconds the cities listed in poi_changes since the last look are
+# reloaded, and after POI_CACHE_TTL seconds the whole cache is.
+# Concurrent writers commit their changes out of id order, so every look also re-reads the
+# changes of the last POI_CHANGE_WINDOW seconds and applies those it has not seen yet
+POI_CACHE_TTL = float(os.getenv('POI_CACHE_TTL') or 3600)
+POI_CACHE_POLL = float(os.getenv('POI_CACHE_POLL') or 5)
+POI_CHANGE_WINDOW = int(os.getenv('POI_CHANGE_WINDOW') or 120)
+poi_cache = {"pois": {}, "keys": {}, "last_change": 0, "seen": set(), "loaded_at": 0.0}
+
+POI_CHANGES_QUERY = "SELECT id, city_id FROM poi_changes WHERE id > %s OR changed_at >= NOW() - INTERVAL %s SECOND"
+
+POI_QUERY = """
+SELECT c.city_id, c.lat, c.lon, c.added, c.started, c.horizon, c.last_hit,
+       q.daily, q.hourly, q.icon, q.icon_15, q.gfs, q.meteofrance
+FROM cities c LEFT JOIN query_urls q ON q.city_id = c.city_id
+"""
+
+def cache_poi(row):
+    city_id, lat, lon, added, started, horizon, last_hit, daily, hourly, icon, icon_15, gfs, meteofrance = row
+    poi_cache["keys"][city_id] = (lat, lon)
+    poi_cache["pois"][(lat, lon)] = {
+        "daily_forecast": daily,
+        "hourly_forecast": hourly,
+        "icon_forecast": icon,
+        "icon_15_forecast": icon_15,
+        "gfs_forecast": gfs,
+        "meteofrance_forecast": meteofrance,
         "added": added,
         "started": started,
         "horizon": horizon,
         "last_hit": last_hit
     }
 
+async def load_pois():
+    async with get_db() as conn:
+        async with conn.cursor() as cur:
+            # changes not seen here are applied by the next refresh, applying one twice is harmless
+            await cur.execute("SELECT COALESCE(MAX(id), 0) FROM poi_changes")
+            last_change = (await cur.fetchone())[0]
+            await cur.execute(POI_CHANGES_QUERY, (last_change, POI_CHANGE_WINDOW))
+            changes = await cur.fetchall()
+            await cur.execute(POI_QUERY)
+            rows = await cur.fetchall()
 
-async def convert_api_response(api_response, generation_time):
-    if not api_response:
-        return JSONResponse(status_code=404, content={"detail": "No data available"}, headers={"X-Error": "No data available"})
+    seen = {change_id for change_id, _ in changes}
+    poi_cache.update(pois={}, keys={}, last_change=max(seen, default=last_change), seen=seen, loaded_at=time.time())
+    for row in rows:
+        cache_poi(row)
+
+async def refresh_pois():
+    async with get_db() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(POI_CHANGES_QUERY, (poi_cache["last_change"], POI_CHANGE_WINDOW))
+            changes = await cur.fetchall()
+            # what is returned now is all that can come back, changes older than the window drop out.
+            # They count as seen only once their cities are reloaded, a failed reload retries them
+            seen = {change_id for change_id, _ in changes}
+            last_change = max(seen, default=poi_cache["last_change"])
+            city_ids = list({city_id for change_id, city_id in changes if change_id not in poi_cache["seen"]})
+            rows = []
+            if city_ids:
+                placeholders = ", ".join(["%s"] * len(city_ids))
+                await cur.execute(POI_QUERY + f"WHERE c.city_id IN ({placeholders})", city_ids)
+                rows = await cur.fetchall()
 
-    dfs = {}
-    all_times = set()
+    # drop the old entries first, a deleted city has no row and a moved one a new key
+    for city_id in city_ids:
+        key = poi_cache["keys"].pop(city_id, None)
+        poi_cache["pois"].pop(key, None)
+    for row in rows:
+        cache_poi(row)
+    poi_cache.update(last_change=last_change, seen=seen)
 
+async def keep_pois_fresh():
+    while True:
+        await asyncio.sleep(POI_CACHE_POLL)
+        try:
+            if time.time() - poi_cache["loaded_at"] > POI_CACHE_TTL:
+                await load_pois()
+            else:
+                await refresh_pois()
+        except Exception as e:
+            # keep serving what is cached, the next poll tries again
+            logger.warning(f"POI cache refresh failed: {e}")
+
+def fetch_poi_metadata(lat, lon):
+    return poi_cache["pois"].get((lat, lon), {})
+
+class ClientDisconnected(Exception):
+    pass
+
+async def run_query(request, query, dialect=None, stream=False):
+    # run a Flux query, cancelled when the HTTP client goes away or INFLUX_QUERY_TIMEOUT passes,
+    # cancelling closes its connection so InfluxDB stops working on it too.
+    # With a dialect the raw CSV is returned instead of FluxTables, with stream the FluxRecords
+    # as an async generator that reads them off the response as InfluxDB sends them
+    if stream:
+        call = app.state.influx_stream.query_api().query_stream(query, org=org)
+    elif dialect:
+        call = app.state.influx.query_api().query_raw(query, org=org, dialect=dialect)
+    else:
+        call = app.state.influx.query_api().query(query, org=org)
+    task = asyncio.ensure_future(call)
+    deadline = time.monotonic() + INFLUX_QUERY_TIMEOUT
     try:
-        for table in api_response:
-            for record in table.records:
-                field = record.values.get("_field")
-                time_value = str(record.values.get("_time"))[:16]
-                value = record.values.get("_value")
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=min(DISCONNECT_POLL, max(0, deadline - time.monotonic())))
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                raise ClientDisconnected()
+            if time.monotonic() >= deadline:
+                raise HTTPException(status_code=504, detail=f"InfluxDB query took longer than {INFLUX_QUERY_TIMEOUT:g}s")
+    finally:
+        task.cancel()
+
 
-                dfs.setdefault(field, []).append(value)
-                all_times.add(time_value)
+# Pivoted query results come back as annotated CSV with only the column types annotated
+PIVOT_DIALECT = Dialect(header=True, delimiter=",", annotations=["datatype"], date_time_format="RFC3339")
+# Columns of a pivoted row that are not fields
+PIVOT_COLUMNS = {"", "result", "table", "_start", "_stop", "_time", "_measurement", "coordinates"}
 
+def pivoted_csv_to_frame(csv_text):
+    # decode every table of the CSV in one read_csv call each, columns keep their InfluxDB type
+    frames = []
+    for table in re.split(r"\r?\n\r?\n", csv_text.strip()):
+        if not table.strip():
+            continue
+        datatypes, body = table.split("\n", 1)
+        frame = pd.read_csv(StringIO(body), dtype={"coordinates": str, "_start": str, "_stop": str, "_time": str}, keep_default_na=False, na_values=[""])
+        for column, datatype in zip(frame.columns, datatypes.strip().split(",")):
+            if datatype in ("long", "unsignedLong"):
+                # nullable ints, a gap does not turn the column into floats
+                frame[column] = frame[column].astype("Int64")
+        frames.append(frame)
+    if not frames:
+        return None
+    return pd.concat(frames, ignore_index=True).sort_values("_time", kind="stable")
+
+def to_minutes(timestamp):
+    # '2024-01-31T13:00:00Z' -> '2024-01-31 13:00', the format the API always answered with
+    return str(timestamp)[:16].replace("T", " ")
+
+async def convert_api_response(api_response, generation_time):
+    # api_response is the CSV of a query pivoted on _time, one row per timestamp and one column per field
+    try:
+        frame = pivoted_csv_to_frame(api_response) if api_response else None
     except Exception as e:
         return JSONResponse(status_code=500, content={"detail": str(e)}, headers={"X-Error": "Server error"})
 
-    try:
-        coordinates = str(api_response[0].records[0].values.get("coordinates"))
-        data_source = str(api_response[0].records[0].values.get("_measurement"))
-        start = str(api_response[0].records[0].values.get("_start"))[:16]
-        stop = str(api_response[0].records[0].values.get("_stop"))[:16]
-    except IndexError:
+    if frame is None or frame.empty:
         return JSONResponse(status_code=404, content={"detail": "No data available"}, headers={"X-Error": "No data available"})
+
+    try:
+        first = frame.iloc[0]
+        coordinates = str(first["coordinates"])
+        data_source = str(first["_measurement"])
+        start = to_minutes(first["_start"])
+        stop = to_minutes(first["_stop"])
     except Exception as e:
         return JSONResponse(status_code=500, content={"detail": str(e)}, headers={"X-Error": "Server error"})
     
     clean_coordinates = coordinates.strip("()").replace(" ", "")
     lat, lon = map(float, clean_coordinates.split(','))
-    city_details_and_urls = await fetch_data_from_database(lat, lon)
+    city_details_and_urls = fetch_poi_metadata(lat, lon)
     url_to_use = city_details_and_urls.get(data_source, None)
 
-    sorted_times = sorted(list(all_times))
-    
     json_data = {
         "status": "success",
         "coordinates": coordinates,
@@ -135,21 +285,88 @@ async def convert_api_response(api_response, generation_time):
         "started": city_details_and_urls.get("started"),
         "last_weather_call": city_details_and_urls.get("last_hit"),
         "query_time_ms": generation_time,
-        "time": sorted_times,
+        "time": [to_minutes(value) for value in frame["_time"].tolist()],
         "results": {},
     }
 
     try:
-        for field, values in dfs.items():
-            json_data["results"][field] = {"value": values}
+        # every field lines up with time, a gap is an explicit null
+        for field in frame.columns:
+            if field in PIVOT_COLUMNS or field.startswith("Unnamed"):
+                continue
+            column = frame[field].astype(object)
+            json_data["results"][field] = {"value": column.where(column.notna(), None).tolist()}
     except Exception as e:
         return JSONResponse(status_code=500, content={"detail": str(e)}, headers={"X-Error": "Server error"})
     
     return json_data
 
 
+# Formats /api/v1/query streams row by row instead of building one JSON document
+STREAM_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+# Rows sent to the client in one chunk
+STREAM_CHUNK_ROWS = 500
+
+async def stream_rows(first, records, fmt):
+    # records are rows of a query pivoted on _time, only the current chunk is held in memory.
+    # The fields are the columns of the first row, a gap is null in ndjson and empty in csv
+    fields = [column for column in first.values if column not in PIVOT_COLUMNS]
+    buffer = StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    if fmt == "csv":
+        writer.writerow(["time"] + fields)
+
+    rows = 0
+    record = first
+    try:
+        while True:
+            values = [record.values.get(field) for field in fields]
+            if fmt == "csv":
+                writer.writerow([to_minutes(record.get_time())] + values)
+            else:
+                buffer.write(json.dumps({"time": to_minutes(record.get_time()), **dict(zip(fields, values))}) + "\n")
+            rows += 1
+            if rows % STREAM_CHUNK_ROWS == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            try:
+                record = await records.__anext__()
+            except StopAsyncIteration:
+                break
+        yield buffer.getvalue()
+    finally:
+        # closes the InfluxDB response too when the client went away mid stream
+        await records.aclose()
+
+async def stream_query(request, query, fmt):
+    try:
+        records = await run_query(request, query, stream=True)
+    except ClientDisconnected:
+        return Response(status_code=499)
+    except HTTPException as he:
+        return JSONResponse(content={"status": "error", "error": he.detail}, status_code=he.status_code)
+    except Exception as e:
+        return JSONResponse(content={"status": "error", "error": str(e)}, status_code=500)
+
+    # wait for the first row, an empty range still gets a 404
+    try:
+        first = await asyncio.wait_for(records.__anext__(), timeout=INFLUX_QUERY_TIMEOUT)
+    except StopAsyncIteration:
+        return JSONResponse(status_code=404, content={"detail": "No data available"}, headers={"X-Error": "No data available"})
+    except asyncio.TimeoutError:
+        await records.aclose()
+        return JSONResponse(content={"status": "error", "error": f"InfluxDB query took longer than {INFLUX_QUERY_TIMEOUT:g}s"}, status_code=504)
+    except Exception as e:
+        await records.aclose()
+        return JSONResponse(content={"status": "error", "error": str(e)}, status_code=500)
+
+    headers = {"X-Coordinates": str(first.values.get("coordinates")), "X-Data-Source": str(first.get_measurement())}
+    return StreamingResponse(stream_rows(first, records, fmt), media_type=STREAM_MEDIA_TYPES[fmt], headers=headers)
+
+
 @app.get("/api/influx/query")
-async def query_influx(source: str, coordinates: str, start_date: str, end_date: str, fields: Optional[str] = None):
+async def query_influx(request: Request, source: str, coordinates: str, start_date: str, end_date: str, fields: Optional[str] = None):
     start = parse(start_date)
     end = parse(end_date)
 
@@ -160,32 +377,43 @@ async def query_influx(source: str, coordinates: str, start_date: str, end_date:
         filters = ' or '.join([f'r._field == "{field}"' for field in field_list])
         query += f' |> filter(fn: (r) => {filters})'
 
-    query_api = client.query_api()
-    result = query_api.query(org=org, query=query)
-    return result
+    try:
+        return await run_query(request, query)
+    except ClientDisconnected:
+        return Response(status_code=499)
 
 
 @app.api_route("/api/v1/query", methods=["GET", "HEAD"])
-async def query_data(request: Request, source: str, coordinates: str, start_date: str, end_date: str, fields: Optional[str] = None):
+async def query_data(request: Request, source: str, coordinates: str, start_date: str, end_date: str, fields: Optional[str] = None, format: str = "json"):
 
     start = parse(start_date)
     end = parse(end_date)
     if start > end:
         raise HTTPException(status_code=400, detail="End date is after start date")
+    if format != "json" and format not in STREAM_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="format must be json, ndjson or csv")
     query = f'from(bucket: "{bucket}") |> range(start: {int(start.timestamp())}, stop: {int(end.timestamp())}) |> filter(fn: (r) => r._measurement == "{source}" and r.coordinates == "{coordinates}")'
     if fields:
         field_list = fields.split(',')
         filters = ' or '.join([f'r._field == "{field}"' for field in field_list])
         query += f' |> filter(fn: (r) => {filters})'
+    # one row per timestamp with a column per field, decoded as columns
+    query += ' |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")'
+    if format in STREAM_MEDIA_TYPES and request.method == "GET":
+        return await stream_query(request, query, format)
     start_time = time.time()
-    query_api = client.query_api()
     try:
-        result = await asyncio.to_thread(query_api.query, org=org, query=query)
+        result = await run_query(request, query, dialect=PIVOT_DIALECT)
+    except ClientDisconnected:
+        # nobody reads the answer
+        return Response(status_code=499)
+    except HTTPException as he:
+        return JSONResponse(content={"status": "error", "error": he.detail}, status_code=he.status_code)
     except Exception as e:
         return JSONResponse(content={"status": "error", "error": str(e)}, status_code=500)
     
     if request.method == "HEAD":
-        if not result or result == []:
+        if not result.strip():
             return JSONResponse(content=None, status_code=404)  # No content with 404 status
         else:
             return Response(headers={"X-Data-Available": "True"})  # Data is available
@@ -198,6 +426,28 @@ async def query_data(request: Request, source: str, coordinates: str, start_date
     
     return json_result
 
+
+@app.get("/api/v1/metrics")
+async def metrics():
+    pool = app.state.db_pool
+    acquired = pool_metrics["acquired"]
+    return {
+        "db_pool": {
+            "size": pool.size if pool else 0,
+            "free": pool.freesize if pool else 0,
+            "maxsize": pool.maxsize if pool else DB_POOL_CONFIG["maxsize"],
+            "acquired": acquired,
+            "timeouts": pool_metrics["timeouts"],
+            "wait_ms_avg": round(pool_metrics["wait_seconds_total"] / acquired * 1000, 3) if acquired else 0.0,
+            "wait_ms_max": round(pool_metrics["wait_seconds_max"] * 1000, 3),
+        },
+        "poi_cache": {
+            "pois": len(poi_cache["pois"]),
+            "age_s": round(time.time() - poi_cache["loaded_at"], 1),
+            "last_change": poi_cache["last_change"],
+        }
+    }
+
 if __name__ == "__main__":
     import uvicorn
 
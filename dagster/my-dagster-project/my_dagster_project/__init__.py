@@ -1,11 +1,19 @@
-from dagster import AssetSelection, Definitions, define_asset_job, load_assets_from_modules, ScheduleDefinition, DefaultScheduleStatus
+import os
+from dagster import EnvVar, AssetSelection, Definitions, define_asset_job, load_assets_from_modules, ScheduleDefinition, DefaultScheduleStatus, multiprocess_executor
 
 from . import assets
+from .io_managers import ColumnarPayloadIOManager
+from .resources import MariaDBResource
 
 all_assets = load_assets_from_modules([assets])
 
 # Addition: define a job that will materialize the assets
-weather_data_job = define_asset_job("weather_data_job", selection=AssetSelection.all())
+# The per-unit fetch and store steps run in parallel, at most DAGSTER_MAX_CONCURRENT at a time
+weather_data_job = define_asset_job(
+    "weather_data_job",
+    selection=AssetSelection.all(),
+    executor_def=multiprocess_executor.configured({"max_concurrent": int(os.getenv('DAGSTER_MAX_CONCURRENT') or 4)}),
+)
 
 weather_data_schedule = ScheduleDefinition(
     job=weather_data_job,
@@ -15,5 +23,15 @@ weather_data_schedule = ScheduleDefinition(
 
 defs = Definitions(
     assets=all_assets,
-    schedules=[weather_data_schedule]  
+    schedules=[weather_data_schedule],
+    resources={
+        "payload_io_manager": ColumnarPayloadIOManager(),
+        "mariadb": MariaDBResource(
+            host=EnvVar('MYSQL_HOST'),
+            user=EnvVar('MYSQL_USER'),
+            password=EnvVar('MYSQL_PASSWORD'),
+            database=EnvVar('MYSQL_DB'),
+            pool_size=int(os.getenv('MYSQL_POOL_SIZE') or 4),
+        ),
+    },
 )
\ No newline at end of file
@@ -0,0 +1,99 @@
+import os
+import json
+import shutil
+from typing import Optional
+
+import numpy as np
+from dagster import ConfigurableIOManager, InputContext, OutputContext
+
+
+def is_series_block(value):
+    """An open-meteo time series block, e.g. 'hourly': a dict of equally long lists."""
+    return isinstance(value, dict) and len(value) > 0 and all(isinstance(column, list) for column in value.values())
+
+
+def to_array(values):
+    """
+    Turn a JSON column into a typed array and its null mask.
+    Integers stay int64 so InfluxDB keeps seeing the same field types, timestamps become datetime64.
+    """
+    present = [value for value in values if value is not None]
+    mask = np.array([value is None for value in values], dtype=bool)
+    if present and all(isinstance(value, str) for value in present):
+        try:
+            return np.array([value or 'NaT' for value in values], dtype='datetime64[m]'), mask
+        except ValueError:
+            return np.array([value or '' for value in values], dtype=str), mask
+    if all(isinstance(value, int) and not isinstance(value, bool) for value in present):
+        return np.array([0 if value is None else value for value in values], dtype=np.int64), mask
+    return np.array([np.nan if value is None else value for value in values], dtype=np.float64), mask
+
+
+class ColumnarPayloadIOManager(ConfigurableIOManager):
+    """
+    Stores the fetched [lat, lon, payload] lists of a step as one .npy file per time series column.
+    The columns of all cities are concatenated, the per city offsets and every other
+    payload key go to a small meta.json. Loading memory maps the columns, the store step
+    gets the same list back with each column as a (masked) numpy view.
+    """
+
+    base_dir: Optional[str] = None
+
+    def _path(self, identifier):
+        base_dir = self.base_dir or os.path.join(os.getenv('DAGSTER_HOME') or '.', 'storage', 'payloads')
+        return os.path.join(base_dir, *identifier)
+
+    def handle_output(self, context: OutputContext, obj):
+        path = self._path(context.get_identifier())
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+
+        cities = []
+        columns = {}
+        for lat, lon, data in obj:
+            city = {'lat': lat, 'lon': lon, 'meta': {}, 'blocks': {}}
+            for key, value in data.items():
+                if not is_series_block(value):
+                    city['meta'][key] = value
+                    continue
+                length = max(len(column) for column in value.values())
+                city['blocks'][key] = list(value)
+                for variable, column in value.items():
+                    columns.setdefault((key, variable), []).append((len(cities), column + [None] * (length - len(column))))
+            cities.append(city)
+
+        # Concatenate every column over the cities, remembering where each city starts
+        files = []
+        for number, ((key, variable), parts) in enumerate(columns.items()):
+            values, mask = to_array([value for _, column in parts for value in column])
+            np.save(os.path.join(path, f"{number}.npy"), values)
+            np.save(os.path.join(path, f"{number}.mask.npy"), mask)
+            offsets, start = {}, 0
+            for index, column in parts:
+                offsets[index] = [start, start + len(column)]
+                start += len(column)
+            files.append({'block': key, 'variable': variable, 'file': number, 'offsets': offsets})
+
+        with open(os.path.join(path, 'meta.json'), 'w') as file:
+            json.dump({'cities': cities, 'columns': files}, file)
+
+        context.add_output_metadata({'cities': len(cities), 'columns': len(files)})
+
+    def load_input(self, context: InputContext):
+        path = self._path(context.upstream_output.get_identifier())
+        with open(os.path.join(path, 'meta.json')) as file:
+            meta = json.load(file)
+
+        payloads = [dict(city['meta'], **{key: {} for key in city['blocks']}) for city in meta['cities']]
+        for column in meta['columns']:
+            values = np.load(os.path.join(path, f"{column['file']}.npy"), mmap_mode='r')
+            mask = np.load(os.path.join(path, f"{column['file']}.mask.npy"), mmap_mode='r')
+            for index, (start, end) in column['offsets'].items():
+                if mask[start:end].any():
+                    series = np.ma.MaskedArray(values[start:end], mask=mask[start:end], copy=False)
+                else:
+                    series = values[start:end]
+                payloads[int(index)][column['block']][column['variable']] = series
+
+        return [[city['lat'], city['lon'], data] for city, data in zip(meta['cities'], payloads)]
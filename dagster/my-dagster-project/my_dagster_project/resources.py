@@ -0,0 +1,20 @@
+from dagster import ConfigurableResource
+
+from ingest.db import get_pool
+
+
+class MariaDBResource(ConfigurableResource):
+    """
+    Pooled MariaDB connections. Every asset running in the same process shares one pool,
+    so connections are reused and never more than `pool_size` are open per process.
+    """
+
+    host: str
+    user: str
+    password: str
+    database: str
+    pool_size: int = 4
+
+    def connection(self):
+        """Borrow a connection for the duration of a with block."""
+        return get_pool(self.host, self.user, self.password, self.database, self.pool_size).connection()
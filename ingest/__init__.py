@@ -0,0 +1,7 @@
+"""
+Shared helpers for the weather ingestion pipeline.
+
+One package used by the Dagster assets, the standalone scripts and the Flask app.
+It is installed into every image from the repository root (pip install .),
+for the scripts run pip install -e . once from the repository root.
+"""
@@ -0,0 +1,92 @@
+import datetime
+
+from .influx import chunked
+
+# Local hour of the run that collects a due city
+RUN_HOUR = 23
+# Keeps the dividend of MOD positive for any offset, SQL's MOD takes the sign of the dividend
+OFFSET_MARGIN = 2 * 86400
+
+
+def run_second(tz):
+    """Seconds after UTC midnight of the first local RUN_HOUR:00 of a city `tz` seconds east of UTC."""
+    return (RUN_HOUR * 3600 - int(tz) + OFFSET_MARGIN) % 86400
+
+
+def next_run_utc(last_hit, horizon, tz):
+    """
+    The next time a city is due, in UTC: the first local RUN_HOUR:00 once `horizon` days have
+    passed since last_hit, read as a UTC date. NEXT_RUN_UTC is the same arithmetic in SQL.
+    """
+    if last_hit is None or tz in (None, ''):
+        return None
+    day = datetime.datetime.combine(last_hit + datetime.timedelta(days=horizon), datetime.time())
+    return day + datetime.timedelta(seconds=run_second(tz))
+
+
+# SQL expression of next_run_utc() for the cities row. Inactive cities and cities without tz
+# or last_hit get NULL and are never due. Assign it after the columns it reads.
+NEXT_RUN_UTC = (
+    "IF(active != 0, DATE_ADD(TIMESTAMP(DATE_ADD(last_hit, INTERVAL horizon DAY)), "
+    f"INTERVAL MOD({RUN_HOUR * 3600} - NULLIF(tz, '') + {OFFSET_MARGIN}, 86400) SECOND), NULL)"
+)
+
+
+def utc_today():
+    """
+    The UTC date of now. last_hit is kept in this clock, the one NEXT_RUN_UTC reads it in,
+    so the host's local date can never push a city a day further than its horizon.
+    """
+    return datetime.datetime.now(datetime.timezone.utc).date()
+
+
+def mark_last_hit(conn, city_ids, day=None, chunk_size=1000):
+    """
+    Set last_hit of all `city_ids` to `day` (today in UTC by default) and move their next_run_utc, within one transaction.
+    The cities are marked changed, so the query API picks up their new last_hit.
+    Each chunk of ids is a single UPDATE ... WHERE city_id IN (...), nothing is
+    committed unless every chunk succeeds. Returns the number of cities marked.
+    """
+    city_ids = list(dict.fromkeys(city_ids))
+    if not city_ids:
+        return 0
+
+    day = day or utc_today()
+    cursor = conn.cursor()
+    try:
+        for chunk in chunked(city_ids, chunk_size):
+            placeholders = ", ".join(["%s"] * len(chunk))
+            cursor.execute(f"UPDATE cities SET last_hit = %s, next_run_utc = {NEXT_RUN_UTC} WHERE city_id IN ({placeholders})", [day, *chunk])
+        mark_poi_changed(cursor, city_ids)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    return len(city_ids)
+
+
+
+def confirmed_cities(writes):
+    """
+    The cities whose writes all reached InfluxDB, from (city_id, written) pairs. `written` is True
+    once InfluxDB took the write, False when it only reached the spool and None when it was never
+    confirmed. A spooled write may still be dropped or set aside, so its city stays due until a write lands.
+    """
+    writes = list(writes)
+    held = {city_id for city_id, written in writes if written is not True}
+    return [city_id for city_id in dict.fromkeys(city_id for city_id, _ in writes) if city_id not in held]
+
+
+def mark_poi_changed(cursor, city_ids):
+    """
+    Record that the metadata of `city_ids` changed (added, edited or deleted), the query API
+    reloads just those cities into its POI cache. Part of the caller's transaction.
+    Entries older than a day are pruned, every cache has been fully reloaded by then.
+    """
+    city_ids = list(city_ids)
+    if city_ids:
+        cursor.executemany("INSERT INTO poi_changes (city_id) VALUES (%s)", [(city_id,) for city_id in city_ids])
+    cursor.execute("DELETE FROM poi_changes WHERE changed_at < NOW() - INTERVAL 1 DAY")
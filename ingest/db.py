@@ -0,0 +1,103 @@
+import os
+import threading
+import logging
+from contextlib import contextmanager
+
+import pymysql
+
+
+class ConnectionPool:
+    """
+    A small pool of MariaDB connections shared by everything running in the process.
+    At most `max_size` connections are open, a borrower waits up to `timeout` seconds
+    for a free one. Idle connections are pinged before they are handed out and
+    replaced when the server dropped them.
+    """
+
+    def __init__(self, max_size=4, timeout=30, **connect_kwargs):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.connect_kwargs = connect_kwargs
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _take_idle(self):
+        # Most recently used first, it is the least likely to have timed out
+        with self._lock:
+            return self._idle.pop() if self._idle else None
+
+    def _borrow(self):
+        conn = self._take_idle()
+        while conn is not None:
+            try:
+                conn.ping(reconnect=False)
+                return conn
+            except Exception as e:
+                logging.warning(f"Dropping dead MariaDB connection ({e})")
+                self._discard(conn)
+                conn = self._take_idle()
+        return pymysql.connect(**self.connect_kwargs)
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _release(self, conn):
+        # End whatever transaction is left open so the next borrower does not read a stale snapshot
+        try:
+            conn.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+        with self._lock:
+            self._idle.append(conn)
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of the with block."""
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f"No free MariaDB connection after {self.timeout}s (pool size {self.max_size})")
+        try:
+            conn = self._borrow()
+            try:
+                yield conn
+            finally:
+                self._release(conn)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._discard(conn)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(host=None, user=None, password=None, database=None, max_size=None):
+    """
+    Return the process wide pool for these credentials, created on first use.
+    Missing arguments are read from MYSQL_HOST, MYSQL_USER, MYSQL_PASSWORD and MYSQL_DB,
+    the size from MYSQL_POOL_SIZE and the borrow timeout from MYSQL_POOL_TIMEOUT.
+    """
+    params = {
+        'host': host or str(os.getenv('MYSQL_HOST')),
+        'user': user or str(os.getenv('MYSQL_USER')),
+        'password': password or str(os.getenv('MYSQL_PASSWORD')),
+        'database': database or str(os.getenv('MYSQL_DB')),
+    }
+    max_size = max_size or int(os.getenv('MYSQL_POOL_SIZE') or 4)
+    key = (params['host'], params['user'], params['database'], max_size)
+
+    with _pools_lock:
+        if key not in _pools:
+            timeout = float(os.getenv('MYSQL_POOL_TIMEOUT') or 30)
+            _pools[key] = ConnectionPool(max_size=max_size, timeout=timeout, **params)
+        return _pools[key]
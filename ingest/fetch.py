@@ -0,0 +1,33 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from . import http_client
+
+
+def fetch_json(url, timeout=None, reserved=False):
+    """Fetch a single url and return the decoded JSON body, `reserved` when its budget was reserved already."""
+    timeout = timeout or float(os.getenv('FETCH_TIMEOUT') or 30)
+    return http_client.get_json(url, timeout=timeout, reserved=reserved)
+
+
+def _fetch_or_error(url, timeout):
+    try:
+        return fetch_json(url, timeout)
+    except Exception as e:
+        return e
+
+
+def fetch_all(urls, max_in_flight=None, timeout=None):
+    """
+    Fetch all urls concurrently, with at most `max_in_flight` requests open at a time.
+    The results are yielded in the same order as `urls`, each as soon as it and the ones
+    before it are in, so the caller can store a result while the later ones are fetched.
+    A failed request does not stop the others, its slot holds the exception instead of the JSON body.
+    """
+    urls = list(urls)
+    if not urls:
+        return
+
+    max_in_flight = max_in_flight or int(os.getenv('FETCH_MAX_IN_FLIGHT') or 8)
+    with ThreadPoolExecutor(max_workers=min(max_in_flight, len(urls))) as executor:
+        yield from executor.map(lambda url: _fetch_or_error(url, timeout), urls)
@@ -0,0 +1,112 @@
+import os
+import time
+import random
+import logging
+import threading
+import datetime
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import ratelimit
+
+# Responses worth another try: rate limited or a transient server error
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Return the process wide Session, its connections are pooled and kept alive between calls."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            pool_size = int(os.getenv('HTTP_POOL_SIZE') or 16)
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+    return _session
+
+
+def backoff_delay(attempt):
+    """Exponential backoff with full jitter for the given retry attempt."""
+    base = float(os.getenv('HTTP_BACKOFF') or 0.5)
+    cap = float(os.getenv('HTTP_BACKOFF_MAX') or 30)
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def retry_after(response):
+    """Seconds to wait according to the Retry-After header, or None if the header is missing or invalid."""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+def request(method, url, timeout=None, retries=None, reserved=False, **kwargs):
+    """
+    Send a request through the pooled session.
+    Connection errors, timeouts and 429/5xx responses are retried up to `retries` times,
+    waiting for Retry-After when the server sends it and for a jittered backoff otherwise.
+    A Retry-After longer than HTTP_RETRY_AFTER_MAX is not waited for.
+    Every attempt is taken from the host's rate limit budget, ratelimit.BudgetExceeded
+    is raised when it is used up. With `reserved` the first attempt was reserved already.
+    `timeout` is the read timeout, the connect timeout comes from HTTP_CONNECT_TIMEOUT.
+    The last response is returned as is, even when it is an error.
+    """
+    connect_timeout = float(os.getenv('HTTP_CONNECT_TIMEOUT') or 5)
+    read_timeout = timeout or float(os.getenv('HTTP_READ_TIMEOUT') or 30)
+    retries = int(os.getenv('HTTP_RETRIES') or 3) if retries is None else retries
+
+    attempt = 0
+    while True:
+        ratelimit.acquire(url, reserved=reserved and attempt == 0)
+        try:
+            response = get_session().request(method, url, timeout=(connect_timeout, read_timeout), **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= retries:
+                raise
+            delay = backoff_delay(attempt)
+            reason = str(e)
+        else:
+            if response.status_code not in RETRY_STATUS or attempt >= retries:
+                return response
+            delay = retry_after(response)
+            if delay is None:
+                delay = backoff_delay(attempt)
+            elif delay > float(os.getenv('HTTP_RETRY_AFTER_MAX') or 60):
+                # Waiting that long would stall the run, leave it to the caller
+                return response
+            reason = f"HTTP {response.status_code}"
+            response.close()
+
+        logging.warning(f"{method} {url} failed ({reason}), retrying in {delay:.1f}s")
+        time.sleep(delay)
+        attempt += 1
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def head(url, **kwargs):
+    return request('HEAD', url, **kwargs)
+
+
+def get_json(url, **kwargs):
+    """GET a url and return the decoded JSON body, raising for error responses."""
+    response = get(url, **kwargs)
+    response.raise_for_status()
+    return response.json()
@@ -0,0 +1,59 @@
+import os
+import time
+import logging
+from influxdb_client import InfluxDBClient
+
+
+def chunked(items, size):
+    """Yield successive lists of at most `size` items."""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class RejectedWrite(Exception):
+    """InfluxDB refused the points with a 4xx (a malformed line, an unknown bucket), writing them again cannot help."""
+
+
+def rejected(error):
+    """True when `error` is a client error response of InfluxDB, 408 and 429 excepted."""
+    status = getattr(error, 'status', None)
+    return isinstance(status, int) and 400 <= status < 500 and status not in (408, 429)
+
+
+def influx_client(url, token, **kwargs):
+    """An InfluxDB client, write requests are gzip compressed unless INFLUX_GZIP=0."""
+    return InfluxDBClient(url=url, token=token, enable_gzip=(os.getenv('INFLUX_GZIP') or '1') != '0', **kwargs)
+
+
+def write_points(write_api, bucket, org, points, batch_size=None, retries=None, write_precision='s'):
+    """
+    Write all points (Points, record dicts or line protocol strings) in batches of `batch_size`,
+    one request per batch. Record and line timestamps are read with `write_precision`,
+    a Point keeps its own precision.
+    A failed batch is retried with exponential backoff, after the last retry
+    the error is raised so the caller can decide what to do with the payload.
+    A batch InfluxDB rejects is not retried, RejectedWrite is raised right away.
+    Returns the number of points written.
+    """
+    batch_size = batch_size or int(os.getenv('INFLUX_BATCH_SIZE') or 5000)
+    retries = int(os.getenv('INFLUX_WRITE_RETRIES') or 3) if retries is None else retries
+    retry_delay = float(os.getenv('INFLUX_RETRY_DELAY') or 1)
+    points = list(points)
+
+    for batch in chunked(points, batch_size):
+        attempt = 0
+        while True:
+            try:
+                write_api.write(bucket, org, batch, write_precision=write_precision)
+                break
+            except Exception as e:
+                if rejected(e):
+                    raise RejectedWrite(f"InfluxDB rejected {len(batch)} points: {e}") from e
+                if attempt >= retries:
+                    raise
+                delay = retry_delay * (2 ** attempt)
+                logging.warning(f"InfluxDB write of {len(batch)} points failed ({e}), retrying in {delay}s")
+                time.sleep(delay)
+                attempt += 1
+
+    return len(points)
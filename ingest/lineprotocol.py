@@ -0,0 +1,72 @@
+import numpy as np
+
+from .sources import SOURCES, to_epoch_seconds, first_row
+
+# The escaping of the influxdb client, so a line is byte for byte what a Point would write
+_ESCAPE_MEASUREMENT = str.maketrans({',': r'\,', ' ': r'\ ', '\n': r'\n', '\t': r'\t', '\r': r'\r'})
+_ESCAPE_KEY = str.maketrans({',': r'\,', '=': r'\=', ' ': r'\ ', '\n': r'\n', '\t': r'\t', '\r': r'\r'})
+
+
+def line_prefix(measurement, tags):
+    """The escaped `measurement,tag=value,...` start of every line of a series, tags sorted like the client does."""
+    prefix = str(measurement).translate(_ESCAPE_MEASUREMENT)
+    for key, value in sorted(tags.items()):
+        value = str(value).translate(_ESCAPE_KEY)
+        if value.endswith('\\'):
+            value += ' '
+        prefix += f",{str(key).translate(_ESCAPE_KEY)}={value}"
+    return prefix
+
+
+def format_column(key, column):
+    """
+    Format a whole column as `key=value` field strings, None where the value is missing.
+    Floats lose a trailing .0 and NaN or infinity are missing, ints get the i suffix,
+    the same field types the client writes for the JSON values.
+    """
+    key = str(key).translate(_ESCAPE_KEY) + '='
+    fields = []
+    for value in column:
+        if value is None:
+            fields.append(None)
+        elif isinstance(value, bool):
+            fields.append(key + str(value).lower())
+        elif isinstance(value, float):
+            if value - value != 0:
+                # NaN or infinity
+                fields.append(None)
+            else:
+                text = str(value)
+                fields.append(key + (text[:-2] if text.endswith('.0') else text))
+        else:
+            fields.append(f"{key}{value}i")
+    return fields
+
+
+def to_lines(source, data, lat, lon, now=None):
+    """
+    Encode an open-meteo payload straight into InfluxDB line protocol, one line per timestamp.
+    The measurement and coordinates tag are escaped once per payload and every column is
+    formatted in one pass, so no Point is built per row. Missing values are left out,
+    a timestamp without any value gives no line. Times are epoch seconds, write them with precision 's'.
+    Rows before first_row for the moment `now` (the current time by default) are not stored.
+    """
+    spec = SOURCES[source]
+    block = data[spec['section']]
+    seconds = to_epoch_seconds(block['time'])
+    skip = first_row(seconds, data.get('utc_offset_seconds', 0), now)
+
+    prefix = line_prefix(spec['measurement'], {'coordinates': str((lat, lon))}) + ' '
+    # Fields in the client's sorted order
+    columns = []
+    for name in sorted(spec['fields']):
+        column = block[spec['fields'][name]][skip:]
+        columns.append(format_column(name, column.tolist() if isinstance(column, np.ndarray) else column))
+    times = seconds[skip:].tolist()
+
+    lines = []
+    for unix_time, fields in zip(times, zip(*columns)):
+        fields = ','.join([field for field in fields if field is not None])
+        if fields:
+            lines.append(f"{prefix}{fields} {unix_time}")
+    return lines
@@ -0,0 +1,44 @@
+import os
+
+
+def plan_groups(items, key, group_size=None):
+    """
+    Group items for multi-location open-meteo calls.
+    Items with the same key(item) share a group and every group holds at most
+    `group_size` items. Groups are returned in the order their first item was seen.
+    """
+    group_size = group_size or int(os.getenv('OPEN_METEO_GROUP_SIZE') or 50)
+
+    buckets = {}
+    for item in items:
+        buckets.setdefault(key(item), []).append(item)
+
+    groups = []
+    for bucket in buckets.values():
+        for i in range(0, len(bucket), group_size):
+            groups.append(bucket[i:i + group_size])
+    return groups
+
+
+def join_coordinates(coordinates):
+    """Return the comma separated latitude and longitude lists for [(lat, lon), ...]."""
+    lats = ",".join(str(lat) for lat, lon in coordinates)
+    lons = ",".join(str(lon) for lat, lon in coordinates)
+    return lats, lons
+
+
+def split_response(data, size):
+    """
+    Split a multi-location response back into one payload per location.
+    Open-meteo answers a single location with an object and several locations
+    with a list in request order. A failed call (an exception) is handed to
+    every location of the group.
+    """
+    if isinstance(data, Exception):
+        return [data] * size
+    if isinstance(data, dict):
+        data = [data]
+    if len(data) != size:
+        error = ValueError(f"Expected {size} locations in the response, got {len(data)}")
+        return [error] * size
+    return data
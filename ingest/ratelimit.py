@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import fcntl
+import datetime
+import urllib.parse
+from contextlib import contextmanager
+
+# Open-Meteo's limits for non-commercial use, override or extend them with the RATE_LIMITS
+# environment variable, e.g. {"api.open-meteo.com": {"minute": 300, "hour": 2500, "day": 5000}}
+DEFAULT_LIMITS = {
+    'api.open-meteo.com': {'minute': 600, 'hour': 5000, 'day': 10000},
+}
+
+
+class BudgetExceeded(Exception):
+    """The request does not fit in what is left of the budget, it should be retried in a later run."""
+
+
+def limits():
+    configured = {host: dict(limit) for host, limit in DEFAULT_LIMITS.items()}
+    configured.update(json.loads(os.getenv('RATE_LIMITS') or '{}'))
+    return configured
+
+
+def request_cost(url):
+    """
+    Calls a request counts for. Open-Meteo counts every location of a multi-location call,
+    and a location with more than 10 variables or more than 14 days as several calls.
+    """
+    parts = urllib.parse.urlsplit(url)
+    if not (parts.hostname or '').endswith('open-meteo.com'):
+        return 1.0
+    query = urllib.parse.parse_qs(parts.query)
+    locations = len(query.get('latitude', [''])[0].split(','))
+    variables = sum(len(value.split(',')) for key in ('hourly', 'daily', 'minutely_15', 'current') for value in query.get(key, []))
+    days = float(query.get('forecast_days', ['7'])[0])
+    return locations * max(1.0, variables / 10) * max(1.0, days / 14)
+
+
+@contextmanager
+def _state():
+    """
+    The budget state of every process on this machine, read and written under a file lock.
+    It lives in RATE_LIMIT_STATE, by default ratelimit.json under DAGSTER_HOME (or the working directory).
+    """
+    path = os.getenv('RATE_LIMIT_STATE') or os.path.join(os.getenv('DAGSTER_HOME') or '.', 'ratelimit.json')
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(path) as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            state = {}
+        yield state
+        with open(path + '.tmp', 'w') as file:
+            json.dump(state, file)
+        os.replace(path + '.tmp', path)
+
+
+def _refresh(entry, limit, now):
+    """Refill the per-minute token bucket and start new hour and day windows."""
+    utc = datetime.datetime.utcfromtimestamp(now)
+    if 'minute' in limit:
+        capacity = limit['minute']
+        tokens = entry.get('tokens', capacity) + (now - entry.get('updated', now)) * capacity / 60
+        entry['tokens'] = min(capacity, tokens)
+    entry['updated'] = now
+    for window, key in (('hour', utc.strftime('%Y-%m-%dT%H')), ('day', utc.strftime('%Y-%m-%d'))):
+        if entry.get(window) != key:
+            entry[window] = key
+            entry[f'{window}_used'] = 0
+    return entry
+
+
+def _fits(entry, limit, cost, host):
+    for window in ('hour', 'day'):
+        if window in limit and entry[f'{window}_used'] + cost > limit[window]:
+            raise BudgetExceeded(f"{host} {window} budget of {limit[window]} calls is used up")
+
+
+def reserve(url, cost=None):
+    """
+    Take `cost` calls (by default what the url counts for) from the hourly and daily budget of the
+    url's host right away, without waiting. Planners reserve a call before handing it out, so calls
+    fetched in parallel can never overrun the budget together. The fetch then passes reserved=True
+    to acquire. Raises BudgetExceeded when the call does not fit any more.
+    """
+    host = urllib.parse.urlsplit(url).hostname
+    limit = limits().get(host)
+    if not limit:
+        return
+    cost = request_cost(url) if cost is None else cost
+    with _state() as state:
+        entry = _refresh(state.setdefault(host, {}), limit, time.time())
+        _fits(entry, limit, cost, host)
+        entry['hour_used'] += cost
+        entry['day_used'] += cost
+
+
+def acquire(url, cost=None, reserved=False):
+    """
+    Take `cost` calls (by default what the url counts for) from the budget of the url's host.
+    Waits for the per-minute bucket to refill, up to RATE_LIMIT_MAX_WAIT seconds.
+    Raises BudgetExceeded when the hourly or daily budget is used up or the wait would be longer.
+    A call `reserved` beforehand only takes from the per-minute bucket.
+    Hosts without configured limits are not limited.
+    """
+    host = urllib.parse.urlsplit(url).hostname
+    limit = limits().get(host)
+    if not limit:
+        return
+    cost = request_cost(url) if cost is None else cost
+    deadline = time.time() + float(os.getenv('RATE_LIMIT_MAX_WAIT') or 120)
+
+    while True:
+        now = time.time()
+        with _state() as state:
+            entry = _refresh(state.setdefault(host, {}), limit, now)
+            if not reserved:
+                _fits(entry, limit, cost, host)
+            # A call bigger than the bucket waits for a full bucket and leaves it in debt
+            needed = min(cost, limit['minute']) if 'minute' in limit else 0
+            if entry.get('tokens', 0) >= needed:
+                if 'minute' in limit:
+                    entry['tokens'] -= cost
+                if not reserved:
+                    entry['hour_used'] += cost
+                    entry['day_used'] += cost
+                return
+            wait = (needed - entry['tokens']) * 60 / limit['minute']
+        if now + wait > deadline:
+            raise BudgetExceeded(f"{host} per-minute budget would need a {wait:.0f}s wait")
+        time.sleep(wait)
+
+
+def remaining(host='api.open-meteo.com'):
+    """What is left of each budget window of `host`, e.g. {'minute': 580.0, 'hour': 4800.0, 'day': 9200.0}."""
+    limit = limits().get(host)
+    if not limit:
+        return {}
+    with _state() as state:
+        entry = _refresh(state.setdefault(host, {}), limit, time.time())
+    left = {}
+    if 'minute' in limit:
+        left['minute'] = round(entry['tokens'], 1)
+    for window in ('hour', 'day'):
+        if window in limit:
+            left[window] = round(limit[window] - entry[f'{window}_used'], 1)
+    return left
@@ -0,0 +1,114 @@
+import os
+import json
+import fcntl
+import queue
+import atexit
+import logging
+import datetime
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Fields a run log record may carry besides the message
+FIELDS = ('run_id', 'stage', 'city_id', 'source', 'duration')
+
+_logger = None
+_listener = None
+_lock = threading.Lock()
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, only the fields that were set."""
+
+    def format(self, record):
+        entry = {'time': datetime.datetime.fromtimestamp(record.created).strftime('%Y-%m-%d %H:%M:%S'), 'level': record.levelname}
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        entry['message'] = record.getMessage()
+        return json.dumps(entry, default=str)
+
+
+class SharedRotatingFileHandler(RotatingFileHandler):
+    """
+    A rotating file handler several processes can write at once, the Dagster steps and weather.py
+    share one run log. Every write and rollover holds an exclusive lock on `<file>.lock`, and a
+    process whose file was rotated away by another reopens the new one before writing.
+    """
+
+    def __init__(self, filename, **kwargs):
+        super().__init__(filename, delay=True, **kwargs)
+        self.lock_file = open(self.baseFilename + '.lock', 'a')
+
+    def rotated(self):
+        """True when the open file is no longer the one at the log's path."""
+        try:
+            return os.stat(self.baseFilename).st_ino != os.fstat(self.stream.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def emit(self, record):
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        try:
+            if self.stream is not None and self.rotated():
+                self.stream.close()
+                self.stream = None
+            super().emit(record)
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def close(self):
+        super().close()
+        self.lock_file.close()
+
+
+def get_run_logger():
+    """
+    Return the run logger, created on first use. Records are put on an in-memory queue
+    and written by a background thread, so logging never waits for the disk.
+    The file (RUN_LOG_FILE) is rotated at RUN_LOG_MAX_BYTES with RUN_LOG_BACKUPS old files kept,
+    whichever process crosses the size rotates it for all.
+    """
+    global _logger, _listener
+    with _lock:
+        if _logger is None:
+            handler = SharedRotatingFileHandler(
+                os.getenv('RUN_LOG_FILE') or 'logfile.log',
+                maxBytes=int(os.getenv('RUN_LOG_MAX_BYTES') or 10 * 1024 * 1024),
+                backupCount=int(os.getenv('RUN_LOG_BACKUPS') or 5),
+            )
+            handler.setFormatter(JsonFormatter())
+
+            records = queue.SimpleQueue()
+            _listener = QueueListener(records, handler)
+            _listener.start()
+
+            logger = logging.getLogger('weather.run')
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            logger.addHandler(QueueHandler(records))
+            _logger = logger
+        return _logger
+
+
+def log_event(message, level=logging.INFO, **fields):
+    """Log one run event, `fields` are any of run_id, stage, city_id, source and duration (seconds)."""
+    get_run_logger().log(level, message, extra={field: fields.get(field) for field in FIELDS})
+
+
+def flush_run_log():
+    """Write out every queued record and stop the writer thread, called at exit."""
+    global _logger, _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            for handler in _listener.handlers:
+                handler.close()
+        if _logger is not None:
+            for handler in list(_logger.handlers):
+                _logger.removeHandler(handler)
+        _logger = None
+        _listener = None
+
+
+atexit.register(flush_run_log)
@@ -0,0 +1,166 @@
+import os
+import time
+import urllib.parse
+
+import numpy as np
+
+# Every forecast source we collect from open-meteo.
+#   label:       name used in the log file
+#   measurement: InfluxDB measurement the data is stored in
+#   endpoint:    open-meteo API endpoint
+#   section:     JSON block (and url parameter) that holds the time series
+#   fields:      InfluxDB field -> open-meteo variable
+SOURCES = {
+    'daily': {
+        'label': 'Daily',
+        'measurement': 'daily_forecast',
+        'endpoint': 'https://api.open-meteo.com/v1/forecast',
+        'section': 'daily',
+        'fields': {
+            'temparature_min_C': 'temperature_2m_min',
+            'temparature_max_C': 'temperature_2m_max',
+            'shortwave_radiation_sum': 'shortwave_radiation_sum',
+            'wind_speed': 'windspeed_10m_max',
+            'wind_direction': 'winddirection_10m_dominant',
+        },
+    },
+    'hourly': {
+        'label': 'Hourly',
+        'measurement': 'hourly_forecast',
+        'endpoint': 'https://api.open-meteo.com/v1/forecast',
+        'section': 'hourly',
+        'fields': {
+            'temperature': 'temperature_2m',
+            'humidity': 'relativehumidity_2m',
+            'windspeed_10m': 'windspeed_10m',
+            'windspeed_80m': 'windspeed_80m',
+            'windspeed_120m': 'windspeed_120m',
+            'windspeed_180m': 'windspeed_180m',
+            'winddirection_10m': 'winddirection_10m',
+            'winddirection_80m': 'winddirection_80m',
+            'winddirection_120m': 'winddirection_120m',
+            'winddirection_180m': 'winddirection_180m',
+            'temperature_80m': 'temperature_80m',
+            'temperature_120m': 'temperature_120m',
+            'temperature_180m': 'temperature_180m',
+            'shortwave_radiation': 'shortwave_radiation',
+            'direct_radiation': 'direct_radiation',
+            'diffuse_radiation': 'diffuse_radiation',
+        },
+    },
+    'icon': {
+        'label': 'ICON',
+        'measurement': 'icon_forecast',
+        'endpoint': 'https://api.open-meteo.com/v1/dwd-icon',
+        'section': 'hourly',
+        'fields': {
+            'temperature': 'temperature_2m',
+            'humidity': 'relativehumidity_2m',
+            'windspeed_10m': 'windspeed_10m',
+            'windspeed_80m': 'windspeed_80m',
+            'windspeed_120m': 'windspeed_120m',
+            'windspeed_180m': 'windspeed_180m',
+            'winddirection_10m': 'winddirection_10m',
+            'winddirection_80m': 'winddirection_80m',
+            'winddirection_120m': 'winddirection_120m',
+            'winddirection_180m': 'winddirection_180m',
+            'windgusts_10m': 'windgusts_10m',
+            'temperature_80m': 'temperature_80m',
+            'temperature_120m': 'temperature_120m',
+            'temperature_180m': 'temperature_180m',
+            'shortwave_radiation': 'shortwave_radiation',
+            'direct_radiation': 'direct_radiation',
+            'diffuse_radiation': 'diffuse_radiation',
+            'direct_normal_irradiance': 'direct_normal_irradiance',
+            'terrestrial_radiation': 'terrestrial_radiation',
+        },
+    },
+    'icon_15': {
+        'label': 'ICON-15',
+        'measurement': 'icon_15_forecast',
+        'endpoint': 'https://api.open-meteo.com/v1/dwd-icon',
+        'section': 'minutely_15',
+        'fields': {
+            'shortwave_radiation': 'shortwave_radiation',
+            'direct_radiation': 'direct_radiation',
+            'diffuse_radiation': 'diffuse_radiation',
+            'direct_normal_irradiance': 'direct_normal_irradiance',
+            'terrestrial_radiation': 'terrestrial_radiation',
+        },
+    },
+    'gfs': {
+        'label': 'GFS',
+        'measurement': 'gfs_forecast',
+        'endpoint': 'https://api.open-meteo.com/v1/gfs',
+        'section': 'hourly',
+        'fields': {
+            'temperature': 'temperature_2m',
+            'humidity': 'relativehumidity_2m',
+            'windspeed_10m': 'windspeed_10m',
+            'windspeed_80m': 'windspeed_80m',
+            'winddirection_10m': 'winddirection_10m',
+            'winddirection_80m': 'winddirection_80m',
+            'windgusts_10m': 'windgusts_10m',
+            'shortwave_radiation': 'shortwave_radiation',
+            'direct_radiation': 'direct_radiation',
+            'diffuse_radiation': 'diffuse_radiation',
+            'direct_normal_irradiance': 'direct_normal_irradiance',
+            'terrestrial_radiation': 'terrestrial_radiation',
+        },
+    },
+    'meteofrance': {
+        'label': 'MeteoFrance',
+        'measurement': 'meteofrance_forecast',
+        'endpoint': 'https://api.open-meteo.com/v1/meteofrance',
+        'section': 'hourly',
+        'fields': {
+            'temperature': 'temperature_2m',
+            'humidity': 'relativehumidity_2m',
+            'windspeed_10m': 'windspeed_10m',
+            'winddirection_10m': 'winddirection_10m',
+            'windgusts_10m': 'windgusts_10m',
+            'shortwave_radiation': 'shortwave_radiation',
+            'direct_radiation': 'direct_radiation',
+            'diffuse_radiation': 'diffuse_radiation',
+            'direct_normal_irradiance': 'direct_normal_irradiance',
+            'terrestrial_radiation': 'terrestrial_radiation',
+        },
+    },
+}
+
+
+def source_url(source, lat, lon, horizon):
+    """
+    Build the open-meteo url of a source. `lat` and `lon` may be comma separated lists
+    for a multi-location call. One extra forecast day is requested for today, first_row cuts it off on store.
+    OPEN_METEO_URL points the endpoints to another server, e.g. a self-hosted open-meteo.
+    """
+    spec = SOURCES[source]
+    endpoint = spec['endpoint']
+    if os.getenv('OPEN_METEO_URL'):
+        endpoint = os.getenv('OPEN_METEO_URL').rstrip('/') + urllib.parse.urlsplit(endpoint).path
+    variables = ",".join(spec['fields'].values())
+    return f"{endpoint}?latitude={lat}&longitude={lon}&{spec['section']}={variables}&timezone=auto&forecast_days={horizon + 1}"
+
+
+def to_epoch_seconds(times):
+    """
+    Convert a whole column of open-meteo timestamps ('2024-01-31' or '2024-01-31T13:00')
+    into epoch seconds in one call. The timestamps are local time of the location and are
+    stored as that wall clock read as UTC, the convention of every point in the bucket:
+    a daily row keeps its own date and 13:00 reads 13:00 in the API and the charts.
+    The result does not depend on the timezone of the machine running the conversion.
+    """
+    return np.array(times, dtype='datetime64[m]').astype(np.int64) * 60
+
+
+def first_row(seconds, utc_offset_seconds, now=None):
+    """
+    Index of the first row to store, from the wall clock epoch seconds of to_epoch_seconds.
+    A run stores from the local date one hour after it runs: at the 23:00 run that is
+    tomorrow, so the extra day covering today is dropped, and a city picked up late,
+    after its local midnight, still gets the day it was due for.
+    """
+    now = time.time() if now is None else now
+    cut = (int(now) + int(utc_offset_seconds) + 3600) // 86400 * 86400
+    return int(np.searchsorted(seconds, cut))
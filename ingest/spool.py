@@ -0,0 +1,211 @@
+import os
+import gzip
+import json
+import time
+import uuid
+import fcntl
+import hashlib
+import logging
+
+from .influx import write_points, RejectedWrite
+
+# A segment is being written to InfluxDB right now
+INFLIGHT = '.inflight'
+# A segment that could not be written and waits for the next drain
+PENDING = '.seg'
+# A segment whose checksum did not match, kept for inspection until the size cap removes it
+CORRUPT = '.corrupt'
+# A segment InfluxDB refused (4xx), kept for inspection until the size cap removes it
+REJECTED = '.rejected'
+
+
+def _order(path):
+    """Sort key of a segment, its sequence number."""
+    return int(os.path.basename(path).split('-')[0])
+
+
+def _size(path):
+    """Size of a segment as recorded in its name."""
+    return int(os.path.basename(path).split('-')[1])
+
+
+class Spool:
+    """
+    Write-ahead spool of InfluxDB records on local disk.
+    Every batch of records is saved as one gzip compressed segment before it is written,
+    the segment is deleted once the write succeeded and kept for the next drain otherwise.
+    A segment starts with the sha256 of its compressed body, a corrupt segment is set aside
+    instead of replayed. The spool never grows past `max_bytes`, the oldest pending
+    segments are dropped first since their forecasts are the most outdated.
+    Several processes may share the directory, a segment is named by a sequence number
+    shared by all of them and its size, so ordering and the size cap never stat a file
+    another process may be removing. The bytes and segments in use are tallied once when
+    the spool is opened and after a drain, and kept up to date by this process in between.
+    """
+
+    def __init__(self, directory=None, max_bytes=None, stale_after=None):
+        self.directory = directory or os.getenv('SPOOL_DIR') or os.path.join(os.getenv('DAGSTER_HOME') or '.', 'spool')
+        self.max_bytes = max_bytes or int(os.getenv('SPOOL_MAX_BYTES') or 1024 ** 3)
+        # In-flight segments older than this were left behind by a crashed run
+        self.stale_after = stale_after or float(os.getenv('SPOOL_STALE_AFTER') or 3600)
+        # After a failed write, records go straight to the spool for this many seconds
+        self.down_for = float(os.getenv('SPOOL_DOWN_FOR') or 60)
+        self.down_until = 0
+        os.makedirs(self.directory, exist_ok=True)
+        self._scan()
+
+    def _segments(self, *suffixes):
+        """Segment paths with one of the suffixes, oldest first."""
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(suffixes)]
+        return sorted(paths, key=_order)
+
+    def _next_sequence(self):
+        """The next segment number, taken under a lock shared by every process using the directory."""
+        fd = os.open(os.path.join(self.directory, 'sequence'), os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            sequence = int(os.pread(fd, 20, 0) or 0) + 1
+            os.pwrite(fd, b"%020d" % sequence, 0)
+        finally:
+            os.close(fd)
+        return sequence
+
+    def _scan(self):
+        """Tally the segments on disk, the evictable ones (everything not in flight) oldest first."""
+        segments = self._segments(PENDING, CORRUPT, REJECTED, INFLIGHT)
+        self.used = sum(_size(path) for path in segments)
+        self.count = len(segments)
+        self._evictable = [path for path in segments if not path.endswith(INFLIGHT)]
+
+    def _forget(self, path):
+        self.used -= _size(path)
+        self.count -= 1
+
+    def _make_room(self, size):
+        while self._evictable and self.used + size > self.max_bytes:
+            path = self._evictable.pop(0)
+            self._forget(path)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Drained or dropped by another process meanwhile
+                continue
+            logging.warning(f"Spool is over {self.max_bytes} bytes, dropped the oldest segment {path}")
+
+    def append(self, records, **meta):
+        """Save `records` with their write parameters as a new in-flight segment and return its path."""
+        lines = [json.dumps(meta)] + [json.dumps(record) for record in records]
+        body = gzip.compress("\n".join(lines).encode(), compresslevel=1)
+        data = hashlib.sha256(body).hexdigest().encode() + b"\n" + body
+        self._make_room(len(data))
+
+        path = os.path.join(self.directory, f"{self._next_sequence():020d}-{len(data)}-{uuid.uuid4().hex}")
+        with open(path + '.tmp', 'wb') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.rename(path + '.tmp', path + INFLIGHT)
+        self.used += len(data)
+        self.count += 1
+        return path + INFLIGHT
+
+    def done(self, path):
+        os.remove(path)
+        self._forget(path)
+
+    def _settle(self, path, settled):
+        """Rename an in-flight segment, it can be evicted from now on."""
+        os.rename(path, settled)
+        self._evictable.append(settled)
+        if len(self._evictable) > 1 and _order(self._evictable[-2]) > _order(settled):
+            # Settled out of order, e.g. a stale segment of a crashed run
+            self._evictable.sort(key=_order)
+
+    def keep(self, path):
+        """Queue an in-flight segment for the next drain."""
+        self._settle(path, path[:-len(INFLIGHT)] + PENDING)
+
+    def set_aside(self, path):
+        """Keep an in-flight segment InfluxDB rejected out of the replay queue, until the size cap removes it."""
+        self._settle(path, path[:-len(INFLIGHT)] + REJECTED)
+
+    def read(self, path):
+        """Return (meta, records) of a segment, raise ValueError when its checksum does not match."""
+        with open(path, 'rb') as file:
+            checksum, body = file.read().split(b"\n", 1)
+        if hashlib.sha256(body).hexdigest().encode() != checksum:
+            raise ValueError(f"Checksum mismatch in spool segment {path}")
+        lines = gzip.decompress(body).decode().split("\n")
+        return json.loads(lines[0]), [json.loads(line) for line in lines[1:]]
+
+    def drain(self, write_api):
+        """
+        Replay the pending segments oldest first, so a replayed forecast never overwrites a newer one.
+        Stops at the first failed write, InfluxDB is most likely still down. A segment InfluxDB
+        rejects is set aside and the drain goes on. Once every pending segment is replayed
+        InfluxDB counts as up again. Returns the records replayed.
+        """
+        for path in self._segments(INFLIGHT):
+            try:
+                if time.time() - os.path.getmtime(path) > self.stale_after:
+                    self.keep(path)
+            except FileNotFoundError:
+                # Settled by its writer meanwhile
+                continue
+
+        replayed = 0
+        for path in self._segments(PENDING):
+            try:
+                meta, records = self.read(path)
+            except FileNotFoundError:
+                # Replayed or dropped by another process
+                continue
+            except Exception as e:
+                logging.error(f"Setting aside unreadable spool segment: {e}")
+                os.rename(path, path + CORRUPT)
+                continue
+            try:
+                write_points(write_api, meta['bucket'], meta['org'], records, write_precision=meta['write_precision'])
+            except RejectedWrite as e:
+                logging.error(f"Setting aside spool segment {path}, {e}")
+                os.rename(path, path + REJECTED)
+                continue
+            except Exception as e:
+                logging.warning(f"Spool drain stopped, InfluxDB write failed: {e}")
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            replayed += len(records)
+        else:
+            self.down_until = 0
+        self._scan()
+        return replayed
+
+
+def write_spooled(spool, write_api, bucket, org, records, write_precision='s'):
+    """
+    Write records through the spool. Returns True when they reached InfluxDB and False
+    when the write failed and they were kept in the spool for the next drain.
+    """
+    records = list(records)
+    path = spool.append(records, bucket=bucket, org=org, write_precision=write_precision)
+    if time.time() < spool.down_until:
+        # InfluxDB just failed, do not wait for it again
+        spool.keep(path)
+        return False
+    try:
+        write_points(write_api, bucket, org, records, write_precision=write_precision)
+    except RejectedWrite as e:
+        # InfluxDB is up, the records themselves are the problem
+        logging.error(f"{e}, set aside in the spool")
+        spool.set_aside(path)
+        return False
+    except Exception as e:
+        logging.warning(f"InfluxDB write of {len(records)} records failed ({e}), kept in the spool")
+        spool.keep(path)
+        spool.down_until = time.time() + spool.down_for
+        return False
+    spool.done(path)
+    return True
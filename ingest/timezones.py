@@ -0,0 +1,91 @@
+import datetime
+from zoneinfo import ZoneInfo
+
+from timezonefinder import TimezoneFinder
+
+from .cities import NEXT_RUN_UTC
+
+_finder = None
+
+
+def finder():
+    """
+    The timezone finder, loaded on first use. timezonefinder ships the timezone polygons
+    preprocessed with a grid of shortcuts, so a lookup only tests the few polygons of its cell.
+    """
+    global _finder
+    if _finder is None:
+        _finder = TimezoneFinder(in_memory=True)
+    return _finder
+
+
+def zone_name(lat, lon):
+    """The IANA zone of a point, an Etc/GMT zone on the open sea, None when there is none."""
+    return finder().timezone_at(lat=float(lat), lng=float(lon))
+
+
+def utc_offsets(coordinates, at=None):
+    """
+    Current UTC offset in seconds of every (lat, lon), None where no zone is found.
+    The offset is computed locally for the moment `at` (now by default), so it follows DST.
+    Every zone is loaded once however many points it holds.
+    """
+    at = at or datetime.datetime.now(datetime.timezone.utc)
+    offsets = {}
+    result = []
+    for lat, lon in coordinates:
+        name = zone_name(lat, lon)
+        if name is None:
+            result.append(None)
+            continue
+        if name not in offsets:
+            offsets[name] = int(at.astimezone(ZoneInfo(name)).utcoffset().total_seconds())
+        result.append(offsets[name])
+    return result
+
+
+def fill_zones(conn, at=None):
+    """
+    Resolve the zone of every city that has none yet (new cities and rows from before tz_name)
+    and store it with its current offset and next_run_utc. Only those rows are read, through
+    the tz_name index. Part of the caller's transaction. Returns the number of cities filled.
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT city_id, lat, lon FROM cities WHERE tz_name IS NULL")
+        cities = cur.fetchall()
+        at = at or datetime.datetime.now(datetime.timezone.utc)
+        names = [zone_name(lat, lon) for _, lat, lon in cities]
+        offsets = {name: int(at.astimezone(ZoneInfo(name)).utcoffset().total_seconds()) for name in set(names) if name is not None}
+        updates = [(name, offsets[name], city_id) for (city_id, _, _), name in zip(cities, names) if name is not None]
+        if updates:
+            cur.executemany(f"UPDATE cities SET tz_name = %s, tz = %s, next_run_utc = {NEXT_RUN_UTC} WHERE city_id = %s", updates)
+    finally:
+        cur.close()
+    return len(updates)
+
+
+def refresh_offsets(conn, at=None):
+    """
+    Bring the tz of every city in line with its zone's current offset and move next_run_utc
+    with it, so a DST change never shifts the 23:00 run. Cities without a zone are filled first.
+    The zones are read off the tz_name index, not the city rows, and a zone's cities are only
+    written when its offset changed, so between DST changes a refresh writes nothing.
+    Returns the number of cities updated.
+    """
+    at = at or datetime.datetime.now(datetime.timezone.utc)
+    cur = conn.cursor()
+    try:
+        updated = fill_zones(conn, at)
+        cur.execute("SELECT DISTINCT tz_name FROM cities WHERE tz_name IS NOT NULL")
+        for (name,) in cur.fetchall():
+            offset = str(int(at.astimezone(ZoneInfo(name)).utcoffset().total_seconds()))
+            cur.execute(f"UPDATE cities SET tz = %s, next_run_utc = {NEXT_RUN_UTC} WHERE tz_name = %s AND NOT tz <=> %s", (offset, name, offset))
+            updated += cur.rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    return updated
@@ -0,0 +1,176 @@
+import os
+import time
+import queue
+import logging
+import threading
+
+from .influx import write_points, RejectedWrite
+
+# Ends the batch being collected right away
+_FLUSH = object()
+# Stops the writer thread
+_STOP = object()
+
+
+def write_mode():
+    """'sync' writes every payload before the run goes on, 'batch' hands it to a BatchWriter (INFLUX_WRITE_MODE)."""
+    return os.getenv('INFLUX_WRITE_MODE') or 'sync'
+
+
+class PendingWrite:
+    """The lines of one submit, `written` is None until the writer is done with them."""
+
+    def __init__(self, count):
+        self.count = count
+        self.written = None
+        self.resolved_at = None
+        self._done = threading.Event()
+
+    def resolve(self, written):
+        self.written = written
+        self.resolved_at = time.time()
+        self._done.set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+
+class BatchWriter:
+    """
+    Background writer of line protocol, the run hands lines over and goes on fetching.
+    A thread collects the submitted lines into batches of up to `batch_size` lines, or whatever
+    came in within `flush_interval` seconds, and writes each batch with write_points.
+    Only the lines of a failed write are saved to the spool, by the writer thread, so a submit
+    never waits for the disk. They are kept for the next drain, or set aside when InfluxDB
+    rejected them. Lines still in memory when the process dies were never confirmed, their
+    cities stay due. At most `max_pending` lines wait in memory, submit blocks until the writer caught up.
+    """
+
+    def __init__(self, write_api, bucket, org, spool, write_precision='s', batch_size=None, flush_interval=None, max_pending=None):
+        self.write_api = write_api
+        self.bucket = bucket
+        self.org = org
+        self.spool = spool
+        self.write_precision = write_precision
+        self.batch_size = batch_size or int(os.getenv('INFLUX_BATCH_SIZE') or 5000)
+        self.flush_interval = flush_interval or float(os.getenv('INFLUX_FLUSH_INTERVAL') or 1)
+        self.max_pending = max_pending or int(os.getenv('INFLUX_MAX_PENDING') or 100000)
+
+        self._queue = queue.Queue()
+        self._submitted = []
+        self._pending = 0
+        self._room = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='influx-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, lines):
+        """Queue lines for writing and return their PendingWrite, blocks while `max_pending` lines wait."""
+        lines = list(lines)
+        with self._room:
+            while self._pending and self._pending + len(lines) > self.max_pending:
+                self._room.wait()
+            self._pending += len(lines)
+
+        write = PendingWrite(len(lines))
+        self._submitted.append(write)
+        self._queue.put((write, lines))
+        return write
+
+    def flush(self, timeout=None):
+        """
+        Write out the batch being collected and wait until every submit is written or spooled.
+        Returns True when all of them are, False when `timeout` seconds passed first.
+        """
+        self._queue.put(_FLUSH)
+        deadline = None if timeout is None else time.time() + timeout
+        for write in self._submitted:
+            if not write.wait(None if deadline is None else max(0, deadline - time.time())):
+                return False
+        return True
+
+    def close(self, timeout=None):
+        """Flush and stop the writer thread, returns what flush returned."""
+        flushed = self.flush(timeout)
+        self._queue.put(_STOP)
+        if flushed:
+            self._thread.join()
+        return flushed
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            if item is _FLUSH:
+                continue
+
+            batch = [item]
+            size = len(item[1])
+            deadline = time.time() + self.flush_interval
+            while size < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if item is _FLUSH or item is _STOP:
+                    break
+                batch.append(item)
+                size += len(item[1])
+            self._write(batch)
+            if item is _STOP:
+                return
+
+    def _write(self, batch):
+        lines = [line for write, write_lines in batch for line in write_lines]
+        outcomes = [False] * len(batch)
+        if time.time() >= self.spool.down_until:
+            try:
+                self._write_lines(lines)
+                outcomes = [True] * len(batch)
+            except RejectedWrite:
+                # Write the submits one by one, so only the rejected ones are set aside
+                outcomes = [self._write_alone(write_lines) for write, write_lines in batch]
+            except Exception as e:
+                logging.warning(f"InfluxDB write of {len(lines)} lines failed ({e}), kept in the spool")
+                self.spool.down_until = time.time() + self.spool.down_for
+
+        for (write, write_lines), outcome in zip(batch, outcomes):
+            if outcome is not True:
+                self._spool(write_lines, rejected=outcome is None)
+            write.resolve(outcome is True)
+
+        self._release(len(lines))
+
+    def _write_lines(self, lines):
+        write_points(self.write_api, self.bucket, self.org, lines, write_precision=self.write_precision)
+
+    def _write_alone(self, lines):
+        """True once written, None when InfluxDB rejected the lines and False when the write failed."""
+        if time.time() < self.spool.down_until:
+            return False
+        try:
+            self._write_lines(lines)
+            return True
+        except RejectedWrite as e:
+            logging.error(f"{e}, set aside in the spool")
+            return None
+        except Exception as e:
+            logging.warning(f"InfluxDB write of {len(lines)} lines failed ({e}), kept in the spool")
+            self.spool.down_until = time.time() + self.spool.down_for
+            return False
+
+    def _spool(self, lines, rejected=False):
+        try:
+            path = self.spool.append(lines, bucket=self.bucket, org=self.org, write_precision=self.write_precision)
+            if rejected:
+                self.spool.set_aside(path)
+            else:
+                self.spool.keep(path)
+        except OSError as e:
+            # Not confirmed either way, the cities stay due
+            logging.error(f"Could not spool {len(lines)} lines: {e}")
+
+    def _release(self, count):
+        with self._room:
+            self._pending -= count
+            self._room.notify_all()
@@ -4,7 +4,9 @@ from werkzeug.utils import url_quote
 import pandas as pd
 import random
 from datetime import datetime, timedelta
-import requests
+from ingest import http_client
+from ingest.cities import NEXT_RUN_UTC, mark_poi_changed
+from ingest.timezones import fill_zones
 import os
 import re
 import csv
@@ -172,6 +174,16 @@ def fetch_coordinates_from_database(city_id):
     cur.close()
     return coordinates
 
+# the query API answers with a 504 once a Flux query runs longer than INFLUX_QUERY_TIMEOUT,
+# so its own calls wait a bit longer than that and are never retried, a retry would only run the slow query again
+API_TIMEOUT = float(os.getenv('INFLUX_QUERY_TIMEOUT') or 30) + 15
+
+def api_get(url):
+    return http_client.get(url, retries=0, timeout=API_TIMEOUT)
+
+def api_head(url):
+    return http_client.head(url, retries=0, timeout=API_TIMEOUT)
+
 def generate_query_api_url(city_coordinates, selected_sources, start_date, end_date):
     city_lat, city_lon = city_coordinates
     api_base_url = str(os.getenv('API_BASE_URL'))
@@ -216,8 +228,9 @@ def store_query_urls(city_data):
             values = (city_id, daily_url, hourly_url, icon_url, icon_15_url, gfs_url, meteofrance_url)
 
             
-            # execute the query
+            # execute the query, the query API picks up the new city
             cur.execute(insert_query, values)
+            mark_poi_changed(cur, [city_id])
             get_db().commit()
 
     except Exception as e:
@@ -226,33 +239,11 @@ def store_query_urls(city_data):
         # close connetction
         cur.close()
 
-def get_timezone(lat, lon):
-    # call open-meteo to get the timezone offset
-    url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&hourly=temperature_2m&timezone=auto&forecast_days=1"
-    response = requests.get(url)
-    response_data = response.json()
-    return response_data['utc_offset_seconds']
-
-def store_timezones(tz_data):
-
-    cur = get_db().cursor()
-
-    # loop through each city to fetch and store timezones
-    for row in tz_data:
-        city_id, _, _, lat, lon, _, _, _, _, _, _, _, _, _, _, _, _, _, _ = row
+def store_timezones():
 
-        # check if tz already exists
-        cur.execute("SELECT tz FROM cities WHERE city_id = %s", (city_id,))
-        if cur.fetchone()[0]:  # If timezone already exists, skip to the next iteration
-            continue
-
-        timezone = get_timezone(lat, lon)
-
-        # update the tz
-        cur.execute("UPDATE cities SET tz = %s WHERE city_id = %s", (timezone, city_id))
-        get_db().commit()
-
-    cur.close()
+    # cities without a zone yet, resolved offline in one go, the tz decides when the city is due next
+    fill_zones(get_db())
+    get_db().commit()
 
 def add_last_hit(lat, lon):
 
@@ -260,8 +251,10 @@ def add_last_hit(lat, lon):
 
     try:
         ten_days_ago = datetime.today().date() - timedelta(days=10)
-        update_query = "UPDATE cities SET last_hit = %s WHERE lat = %s AND lon = %s"
+        update_query = f"UPDATE cities SET last_hit = %s, next_run_utc = {NEXT_RUN_UTC} WHERE lat = %s AND lon = %s"
         cursor.execute(update_query, (ten_days_ago, lat, lon))
+        cursor.execute("SELECT city_id FROM cities WHERE lat = %s AND lon = %s", (lat, lon))
+        mark_poi_changed(cursor, [row[0] for row in cursor.fetchall()])
         get_db().commit()
     finally:
         cursor.close()
@@ -320,7 +313,7 @@ def data_charts():
 
         # combine the information into an API URL
         api_url = generate_data_api_url(city_coordinates, selected_sources, start_date, end_date, selected_parameters)
-        response = requests.head(api_url)
+        response = api_head(api_url)
 
         if day_difference > 90:
             flash_message('Date range is more than 90 days', 'error')
@@ -330,7 +323,7 @@ def data_charts():
             flash_message('There is no data available for the selected date range', 'error')
             return render_template('data_charts.html', cities=cities, data=None)
 
-        query_api_response = requests.get(api_url).json()
+        query_api_response = api_get(api_url).json()
         print(api_url)
 
         return render_template(
@@ -373,7 +366,7 @@ def data_tables():
 
         # combine the information into an API URL
         query_url = generate_query_api_url(city_coordinates, selected_sources, start_date, end_date)
-        query_api_response = requests.get(query_url).json()
+        query_api_response = api_get(query_url).json()
 
         dfs = {}
 
@@ -465,7 +458,7 @@ def data():
         weather_query_urls = fetch_query_urls_from_database(selected_city_id)
         url_to_use = weather_query_urls.get(selected_sources, None)
 
-        response = requests.head(api_url)
+        response = api_head(api_url)
 
         if response.status_code == 404 or response.headers.get("X-Data-Available") == "False":
             return render_template('no_data.html', cities=cities, api_url=api_url, city_coordinates=city_coordinates, 
@@ -492,7 +485,7 @@ def export_csv():
     started = request.form.get('started')
     horizon = request.form.get('horizon')
     
-    response = requests.get(api_url)
+    response = api_get(api_url)
     if response.status_code != 200:
         return 'Failed to retrieve data', 500
     
@@ -542,7 +535,7 @@ def export_json():
     coordinates = request.form.get('coordinates')
     url_to_use = request.form.get('url_to_use')
     
-    response = requests.get(api_url)
+    response = api_get(api_url)
     
     if response.status_code != 200:
         return 'Failed to retrieve data', 500
@@ -603,7 +596,7 @@ def add_city():
         flash_message(f'{city} is already on the list of cities.')
     else:
         url = f'https://maps.googleapis.com/maps/api/geocode/json?address={city}&key={google_api_key}'
-        response = requests.get(url).json()
+        response = http_client.get(url).json()
         if response['status'] == "ZERO_RESULTS":
             flash_message('Invalid city name! Please try again...')
             return redirect(('/cities'))
@@ -631,8 +624,7 @@ def add_city():
 
         city_data = retrieve_city_data()
         store_query_urls(city_data)
-        tz_data = retrieve_city_data()
-        store_timezones(tz_data)
+        store_timezones()
 
         flash_message(f'{city} has been added to the list. The closest coordinates are {lat_valid} & {lon_valid}')
     return redirect(('/cities'))
@@ -661,7 +653,7 @@ def add_city_coords():
         flash_message(f'{lat_valid} & {lon_valid} is already on the list.')
     else:
         url = f'https://maps.googleapis.com/maps/api/geocode/json?latlng={lat_valid},{lon_valid}&key={google_api_key}'
-        response = requests.get(url).json()
+        response = http_client.get(url).json()
         if response['status'] == "INVALID_REQUEST":
             flash_message('Invalid Coordinates! Please try again...')
             return redirect(('/cities'))
@@ -672,7 +664,7 @@ def add_city_coords():
                       city = component["long_name"]
                    else: 
                        url2 = f'http://api.openweathermap.org/geo/1.0/reverse?lat={lat_valid}&lon={lon_valid}&limit=1&appid={api_key}'
-                       response2 = requests.get(url2).json()
+                       response2 = http_client.get(url2).json()
                        if len(response2) != 0:
                             city = response2[0]['name']
                             country_code2 = response2[0]['country']
@@ -699,8 +691,7 @@ def add_city_coords():
 
         city_data = retrieve_city_data()
         store_query_urls(city_data)
-        tz_data = retrieve_city_data()
-        store_timezones(tz_data)
+        store_timezones()
 
         flash_message(f'{lat_valid} & {lon_valid} has been added to the list! The closest city is {city}.')
     return redirect(('/cities'))
@@ -711,14 +702,15 @@ def toggle_active(city_id, active):
     cur = mysql.connection.cursor()
     if active == 1:
         # active city set the started column
-        cur.execute("UPDATE cities SET active = %s, started = %s WHERE city_id = %s", 
+        cur.execute(f"UPDATE cities SET active = %s, started = %s, next_run_utc = {NEXT_RUN_UTC} WHERE city_id = %s", 
                     (active, datetime.now().date() + timedelta(days=1), city_id))
         flash_message('City has been activated successfully!')
     else:
-        # deactivating  city only change active column
-        cur.execute("UPDATE cities SET active = %s WHERE city_id = %s", (active, city_id))
+        # deactivating  city only change active column, an inactive city is never due
+        cur.execute("UPDATE cities SET active = %s, next_run_utc = NULL WHERE city_id = %s", (active, city_id))
         flash_message('City has been deactivated successfully!')
-        
+
+    mark_poi_changed(cur, [city_id])
     mysql.connection.commit()
     cur.close()
     
@@ -764,6 +756,7 @@ def delete():
     # delete city data drom sql
     try:
         cur.execute("DELETE FROM cities WHERE city_id = %s", (city_id,))
+        mark_poi_changed(cur, [city_id])
         mysql.connection.commit()
         flash_message(f'Location data for {city} and ALL related weather data from InfluxDB have been removed.')
         
@@ -781,6 +774,7 @@ def remove():
     id = request.form['id']
     cur = mysql.connection.cursor()
     cur.execute("DELETE FROM cities WHERE city_id = %s", (id,))
+    mark_poi_changed(cur, [id])
     mysql.connection.commit()
     cur.close()
     flash_message('City has been removed.')
@@ -18,6 +18,7 @@ CREATE TABLE IF NOT EXISTS `cities` (
   `lat` double NOT NULL,
   `lon` double NOT NULL,
   `tz` varchar(50) DEFAULT NULL,
+  `tz_name` varchar(64) DEFAULT NULL,
   `country` varchar(255) DEFAULT NULL,
   `country_code` varchar(255) NOT NULL,
   `added` date NOT NULL,
@@ -31,9 +32,21 @@ CREATE TABLE IF NOT EXISTS `cities` (
   `horizon` int(11) DEFAULT 0,
   `comment` text DEFAULT NULL,
   `last_hit` date DEFAULT NULL,
-  PRIMARY KEY (`city_id`) USING BTREE
+  `next_run_utc` datetime DEFAULT NULL,
+  PRIMARY KEY (`city_id`) USING BTREE,
+  KEY `idx_next_run_utc` (`next_run_utc`),
+  KEY `idx_tz_name` (`tz_name`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb3;
 
+-- Upgrade of databases created before next_run_utc: the first local 23:00 once the horizon has passed since last_hit
+ALTER TABLE `cities` ADD COLUMN IF NOT EXISTS `next_run_utc` datetime DEFAULT NULL;
+CREATE INDEX IF NOT EXISTS `idx_next_run_utc` ON `cities` (`next_run_utc`);
+UPDATE `cities` SET `next_run_utc` = IF(active != 0, DATE_ADD(TIMESTAMP(DATE_ADD(last_hit, INTERVAL horizon DAY)), INTERVAL MOD(82800 - NULLIF(tz, '') + 172800, 86400) SECOND), NULL) WHERE `next_run_utc` IS NULL;
+
+-- Upgrade of databases created before tz_name: the IANA zone of a city, filled by the next timezone refresh
+ALTER TABLE `cities` ADD COLUMN IF NOT EXISTS `tz_name` varchar(64) DEFAULT NULL AFTER `tz`;
+CREATE INDEX IF NOT EXISTS `idx_tz_name` ON `cities` (`tz_name`);
+
 CREATE TABLE IF NOT EXISTS `parameters` (
   `source` varchar(255) DEFAULT NULL,
   `parameter` varchar(255) DEFAULT NULL,
@@ -125,6 +138,15 @@ CREATE TABLE IF NOT EXISTS `query_urls` (
   CONSTRAINT `query_urls_ibfk_3` FOREIGN KEY (`city_id`) REFERENCES `cities` (`city_id`) ON DELETE CASCADE
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 
+-- Cities whose metadata changed, the query API reloads them into its POI cache
+CREATE TABLE IF NOT EXISTS `poi_changes` (
+  `id` bigint(20) NOT NULL AUTO_INCREMENT,
+  `city_id` int(11) NOT NULL,
+  `changed_at` timestamp NOT NULL DEFAULT current_timestamp(),
+  PRIMARY KEY (`id`),
+  KEY `idx_changed_at` (`changed_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
 CREATE TABLE IF NOT EXISTS `urls` (
   `daily` varchar(250) DEFAULT NULL,
   `hourly` varchar(250) DEFAULT NULL,
@@ -0,0 +1,291 @@
+"""
+End-to-end benchmark of the ingestion on synthetic POIs.
+
+Starts a local stand-in of Open-Meteo, which answers every source with realistic payloads
+after a configurable latency, and of the InfluxDB write endpoint, which counts the points
+and bytes it receives. Then seeds N synthetic POIs, all due and at 23:00 local time, into a
+scratch MariaDB database and runs weather.py and the Dagster job against both stand-ins.
+Reported per run: wall time, requests, points/s, peak RSS and the per-stage breakdown of the run log.
+
+The database is emptied on every seed, so point MYSQL_HOST, MYSQL_USER and MYSQL_PASSWORD
+to a server where --database (weather_bench by default) may be dropped and recreated.
+Run from the scripts directory: python bench_ingest.py --pois 100 1000 10000
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import random
+import argparse
+import datetime
+import tempfile
+import threading
+import subprocess
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pymysql
+from dotenv import load_dotenv
+from ingest.cities import NEXT_RUN_UTC
+from ingest.timezones import utc_offsets
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(SCRIPTS_DIR)
+DAGSTER_DIR = os.path.join(ROOT_DIR, 'dagster', 'my-dagster-project')
+
+# Integer variables of open-meteo, every other variable is a float with one decimal
+INTEGER_VARIABLES = ('relativehumidity', 'winddirection')
+# Rows per forecast day of each section
+ROWS_PER_DAY = {'daily': 1, 'hourly': 24, 'minutely_15': 96}
+
+
+class Counters:
+    """Requests, points and bytes seen by the stand-ins, shared by their handler threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.values = {'open_meteo_requests': 0, 'open_meteo_locations': 0, 'open_meteo_bytes': 0,
+                           'influx_requests': 0, 'influx_points': 0, 'influx_bytes': 0, 'influx_raw_bytes': 0}
+
+    def add(self, **values):
+        with self.lock:
+            for key, value in values.items():
+                self.values[key] += value
+
+
+class OpenMeteoHandler(BaseHTTPRequestHandler):
+    """Answers /v1/<model> like open-meteo, a list for a multi-location call and an object otherwise."""
+
+    latency = 0.0
+    counters = None
+    _blocks = {}
+    _lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    @classmethod
+    def block(cls, section, variables, days):
+        """The JSON of the time series shared by every location of a request shape, built once."""
+        key = (section, variables, days)
+        with cls._lock:
+            if key not in cls._blocks:
+                rng = random.Random(hash(key))
+                rows = ROWS_PER_DAY[section] * days
+                start = datetime.datetime.combine(datetime.date.today(), datetime.time())
+                step = datetime.timedelta(days=1) / ROWS_PER_DAY[section]
+                time_format = '%Y-%m-%d' if section == 'daily' else '%Y-%m-%dT%H:%M'
+                block = {'time': [(start + step * row).strftime(time_format) for row in range(rows)]}
+                for variable in variables.split(','):
+                    if variable.startswith(INTEGER_VARIABLES):
+                        column = [rng.randint(0, 100) for _ in range(rows)]
+                    else:
+                        column = [round(rng.uniform(-10, 40), 1) for _ in range(rows)]
+                    # The last rows of a model run are often null
+                    block[variable] = column[:-max(1, rows // 32)] + [None] * max(1, rows // 32)
+                cls._blocks[key] = json.dumps({section: block})[1:-1]
+            return cls._blocks[key]
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        section = next(name for name in ROWS_PER_DAY if name in query)
+        block = self.block(section, query[section][0], int(query.get('forecast_days', ['7'])[0]))
+
+        locations = []
+        for lat, lon in zip(query['latitude'][0].split(','), query['longitude'][0].split(',')):
+            offset = round(float(lon) / 15) * 3600
+            locations.append(f'{{"latitude":{lat},"longitude":{lon},"utc_offset_seconds":{offset},{block}}}')
+        body = (locations[0] if len(locations) == 1 else '[' + ','.join(locations) + ']').encode()
+
+        self.counters.add(open_meteo_requests=1, open_meteo_locations=len(locations), open_meteo_bytes=len(body))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class InfluxHandler(BaseHTTPRequestHandler):
+    """Takes /api/v2/write requests, counts their points and bytes and drops them."""
+
+    counters = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        # /ping and /health
+        self.send_response(204)
+        self.end_headers()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        raw = gzip.decompress(body) if self.headers.get('Content-Encoding') == 'gzip' else body
+        points = sum(1 for line in raw.split(b'\n') if line.strip())
+        self.counters.add(influx_requests=1, influx_points=points, influx_bytes=len(body), influx_raw_bytes=len(raw))
+        self.send_response(204)
+        self.end_headers()
+
+
+def serve(handler):
+    """Start a stand-in on a free local port, return its base url."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def connect(database=None):
+    return pymysql.connect(user=str(os.getenv('MYSQL_USER')), password=str(os.getenv('MYSQL_PASSWORD')), host=str(os.getenv('MYSQL_HOST')), database=database)
+
+
+def create_schema(database):
+    """Recreate the benchmark database from mydb.sql."""
+    with open(os.path.join(ROOT_DIR, 'mydb.sql'), encoding='utf-8') as file:
+        script = file.read().replace('`NTUA`', f'`{database}`')
+    conn = connect()
+    try:
+        cur = conn.cursor()
+        cur.execute(f"DROP DATABASE IF EXISTS `{database}`")
+        for statement in script.split(';\n'):
+            if statement.strip():
+                cur.execute(statement)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def synthetic_pois(count, seed=0):
+    """
+    `count` random POIs where it is 23:00 right now. Candidates are drawn around the meridian
+    of the wanted offset and kept when the offline resolver agrees, the same resolver the run uses.
+    """
+    rng = random.Random(seed)
+    hours = (23 - datetime.datetime.utcnow().hour) % 24
+    hours = hours - 24 if hours > 12 else hours
+    pois = []
+    while len(pois) < count:
+        candidates = [(round(rng.uniform(-60, 60), 4), round((hours * 15 + rng.uniform(-7.4, 7.4) + 180) % 360 - 180, 4)) for _ in range(count)]
+        pois.extend(poi for poi, offset in zip(candidates, utc_offsets(candidates)) if offset == hours * 3600)
+    return pois[:count]
+
+
+def seed(database, pois, horizon):
+    """Replace the cities with the POIs, every source enabled and due now."""
+    today = datetime.date.today()
+    rows = [(f"bench-{i}", lat, lon, tz, 'XX', today, today, horizon, today - datetime.timedelta(days=10)) for i, ((lat, lon), tz) in enumerate(zip(pois, utc_offsets(pois)))]
+    conn = connect(database)
+    try:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM cities")
+        cur.executemany("INSERT INTO cities (name, lat, lon, tz, country_code, added, started, daily, hourly, icon, icon_15, gfs, meteofrance, horizon, last_hit) VALUES (%s, %s, %s, %s, %s, %s, %s, 1, 1, 1, 1, 1, 1, %s, %s)", rows)
+        conn.commit()
+        cur.close()
+    finally:
+        conn.close()
+    make_due(database)
+
+
+def make_due(database):
+    """Move every POI back to 10 days since its last run, so the next run collects all of them."""
+    conn = connect(database)
+    try:
+        cur = conn.cursor()
+        cur.execute(f"UPDATE cities SET last_hit = DATE_SUB(CURDATE(), INTERVAL 10 DAY), next_run_utc = {NEXT_RUN_UTC}")
+        conn.commit()
+        cur.close()
+    finally:
+        conn.close()
+
+
+def run(command, cwd, env):
+    """Run a command to completion, return (seconds, peak RSS in MB of its largest process, exit status)."""
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    stderr = process.stderr.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    elapsed = time.perf_counter() - start
+    if process.returncode != 0:
+        sys.stderr.write(stderr.decode(errors='replace')[-2000:])
+    # ru_maxrss is in kB on Linux
+    return elapsed, usage.ru_maxrss / 1024, process.returncode
+
+
+def stages(run_log):
+    """Events and summed durations per stage of a run log."""
+    breakdown = {}
+    if not os.path.exists(run_log):
+        return breakdown
+    with open(run_log) as file:
+        for line in file:
+            entry = json.loads(line)
+            stage = breakdown.setdefault(entry.get('stage', '-'), {'events': 0, 'seconds': 0.0})
+            stage['events'] += 1
+            stage['seconds'] += entry.get('duration') or 0
+    return breakdown
+
+
+def report(target, pois, elapsed, rss, status, counters, breakdown):
+    values = counters.values
+    print(f"{target} with {pois} POIs{'' if status == 0 else f' FAILED ({status})'}")
+    print(f"  wall time:   {elapsed:.2f}s")
+    print(f"  requests:    {values['open_meteo_requests']} open-meteo ({values['open_meteo_locations']} locations, {values['open_meteo_bytes'] / 1e6:.1f} MB), {values['influx_requests']} influx")
+    print(f"  points:      {values['influx_points']:,} ({values['influx_points'] / elapsed:,.0f}/s), {values['influx_bytes'] / 1e6:.1f} MB sent, {values['influx_raw_bytes'] / 1e6:.1f} MB uncompressed")
+    print(f"  peak RSS:    {rss:.0f} MB")
+    for name, stage in sorted(breakdown.items()):
+        print(f"  {name + ':':12} {stage['events']} events, {stage['seconds']:.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--pois', type=int, nargs='+', default=[100, 1000, 10000], help='POI counts to run')
+    parser.add_argument('--targets', nargs='+', default=['script', 'dagster'], choices=['script', 'dagster'])
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds before the open-meteo stand-in answers')
+    parser.add_argument('--horizon', type=int, default=3, help='forecast days of every POI')
+    parser.add_argument('--database', default='weather_bench', help='scratch database, dropped and recreated')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    load_dotenv()
+    counters = Counters()
+    OpenMeteoHandler.latency = args.latency
+    OpenMeteoHandler.counters = counters
+    InfluxHandler.counters = counters
+    open_meteo_url = serve(OpenMeteoHandler)
+    influx_url = serve(InfluxHandler)
+    create_schema(args.database)
+
+    results = []
+    for pois in args.pois:
+        seed(args.database, synthetic_pois(pois), args.horizon)
+        for target in args.targets:
+            make_due(args.database)
+            counters.reset()
+            workdir = tempfile.mkdtemp(prefix=f"bench-{target}-{pois}-")
+            run_log = os.path.join(workdir, 'run.log')
+            env = dict(os.environ, MYSQL_DB=args.database, OPEN_METEO_URL=open_meteo_url, INFLUXDB_HOST=influx_url,
+                       INFLUXDB_BUCKET='bench', INFLUXDB_ORG='bench', INFLUX_TOKEN='bench', RUN_LOG_FILE=run_log,
+                       SPOOL_DIR=os.path.join(workdir, 'spool'), RATE_LIMIT_STATE=os.path.join(workdir, 'ratelimit.json'),
+                       DAGSTER_HOME=workdir)
+            if target == 'script':
+                elapsed, rss, status = run([sys.executable, 'weather.py'], SCRIPTS_DIR, env)
+            else:
+                elapsed, rss, status = run(['dagster', 'job', 'execute', '-m', 'my_dagster_project', '-j', 'weather_data_job'], DAGSTER_DIR, env)
+            breakdown = stages(run_log)
+            report(target, pois, elapsed, rss, status, counters, breakdown)
+            results.append({'target': target, 'pois': pois, 'status': status, 'seconds': round(elapsed, 3), 'peak_rss_mb': round(rss, 1), **counters.values, 'stages': breakdown})
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
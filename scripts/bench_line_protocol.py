@@ -0,0 +1,76 @@
+"""
+Benchmark of the InfluxDB serialization of ICON payloads on a synthetic run.
+
+Compares the old per-row path of store_icon_data_in_influxdb (a Point with a chained
+.tag().field() call per field for every row, serialized by the client) with the one pass
+line protocol encoder of ingest.lineprotocol. Both must give the same lines.
+Run from the scripts directory: python bench_line_protocol.py [N_POIS]
+"""
+import sys
+import time
+import random
+import datetime
+from influxdb_client import Point
+from ingest.sources import SOURCES, to_epoch_seconds
+from ingest.lineprotocol import to_lines
+
+N_POIS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+HOURS = 24 + 7 * 24
+SOURCE = 'icon'
+# The 23:00 run of the synthetic payloads (UTC+1), their first day is cut off
+RUN_AT = datetime.datetime(2024, 3, 30, 22, 0, tzinfo=datetime.timezone.utc).timestamp()
+
+
+def synthetic_payloads():
+    rng = random.Random(0)
+    start = datetime.datetime(2024, 3, 30)
+    times = [(start + datetime.timedelta(hours=h)).strftime("%Y-%m-%dT%H:%M") for h in range(HOURS)]
+    payloads = []
+    for i in range(N_POIS):
+        block = {'time': list(times)}
+        for variable in SOURCES[SOURCE]['fields'].values():
+            if variable.startswith(('relativehumidity', 'winddirection')):
+                column = [rng.randint(0, 100) for _ in times]
+            else:
+                column = [round(rng.uniform(-10, 40), 1) for _ in times]
+            # The last hours of a model run are often null
+            block[variable] = column[:-6] + [None] * 6
+        payloads.append({'latitude': 48.0 + i / 1000, 'longitude': 11.5, 'utc_offset_seconds': 3600, 'hourly': block})
+    return payloads
+
+
+def point_lines(data, lat, lon):
+    # The per-row Point building the store functions used before
+    spec = SOURCES[SOURCE]
+    block = data['hourly']
+    columns = [block[variable][24:] for variable in spec['fields'].values()]
+    times = to_epoch_seconds(block['time'][24:]).tolist()
+    lines = []
+    for unix_time, values in zip(times, zip(*columns)):
+        point = Point(spec['measurement']).tag("coordinates", (lat, lon))
+        for name, value in zip(spec['fields'], values):
+            point = point.field(name, value)
+        line = point.time(unix_time, write_precision='s').to_line_protocol()
+        if line:
+            lines.append(line)
+    return lines
+
+
+def main():
+    payloads = synthetic_payloads()
+    results = {}
+    for name, encode in (('per-row Point', point_lines), ('line protocol', lambda data, lat, lon: to_lines(SOURCE, data, lat, lon, now=RUN_AT))):
+        start = time.perf_counter()
+        lines = [encode(data, data['latitude'], data['longitude']) for data in payloads]
+        results[name] = (time.perf_counter() - start, lines)
+
+    assert results['per-row Point'][1] == results['line protocol'][1]
+    rows = sum(len(lines) for lines in results['line protocol'][1])
+    print(f"{N_POIS} {SOURCE} POIs, {rows} lines")
+    for name, (elapsed, _) in results.items():
+        print(f"{name + ':':15} {elapsed:.3f}s ({rows / elapsed:,.0f} lines/s)")
+    print(f"speedup:        {results['per-row Point'][0] / results['line protocol'][0]:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
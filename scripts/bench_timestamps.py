@@ -0,0 +1,57 @@
+"""
+Benchmark of the timestamp conversion on a synthetic run.
+
+Compares the old per-row path (strptime and a local timezone lookup for every row)
+with the column conversion used by ingest.sources on the hourly time column of
+N_POIS payloads. Run from the scripts directory: python bench_timestamps.py
+"""
+import sys
+import time
+import datetime
+from ingest.sources import to_epoch_seconds
+
+N_POIS = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+HOURS = 48
+
+
+def local_offset():
+    """Get the local timezone offset in hours from UTC."""
+    offset_seconds = -time.altzone if time.localtime().tm_isdst else -time.timezone
+    return offset_seconds / 3600
+
+
+def time_to_unixtime(date_string):
+    # The per-row conversion the store functions used before
+    datetime_object = datetime.datetime.strptime(date_string, "%Y-%m-%dT%H:%M")
+    datetime_object += datetime.timedelta(hours=local_offset())
+    return int(datetime_object.timestamp())
+
+
+def synthetic_payloads():
+    start = datetime.datetime(2024, 3, 30)
+    times = [(start + datetime.timedelta(hours=h)).strftime("%Y-%m-%dT%H:%M") for h in range(HOURS)]
+    return [{'hourly': {'time': list(times)}} for i in range(N_POIS)]
+
+
+def main():
+    payloads = synthetic_payloads()
+    rows = N_POIS * HOURS
+
+    start = time.perf_counter()
+    for data in payloads:
+        [time_to_unixtime(value) for value in data['hourly']['time']]
+    per_row = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for data in payloads:
+        to_epoch_seconds(data['hourly']['time']).tolist()
+    column = time.perf_counter() - start
+
+    print(f"{N_POIS} POIs, {rows} timestamps")
+    print(f"per-row strptime: {per_row:.3f}s ({rows / per_row:,.0f} rows/s)")
+    print(f"column numpy:     {column:.3f}s ({rows / column:,.0f} rows/s)")
+    print(f"speedup:          {per_row / column:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,21 @@
-import pymysql
-import requests
 import os 
-import re
-import datetime
 import time
 import logging
+import uuid
 from dotenv import  load_dotenv
-from influxdb_client import InfluxDBClient, Point
 from influxdb_client.client.write_api import SYNCHRONOUS
+from ingest.fetch import fetch_all
+from ingest.planner import plan_groups, join_coordinates, split_response
+from ingest.sources import SOURCES, source_url
+from ingest.lineprotocol import to_lines
+from ingest.influx import influx_client
+from ingest.cities import mark_last_hit, confirmed_cities, utc_today
+from ingest.timezones import refresh_offsets
+from ingest.db import get_pool
+from ingest.runlog import log_event
+from ingest.spool import Spool, write_spooled
+from ingest.writer import BatchWriter, write_mode
+from ingest.ratelimit import BudgetExceeded, remaining
 
 # Start timer
 start_time = time.time()
@@ -15,13 +23,12 @@ start_time = time.time()
 # Load environment variables
 load_dotenv()
 
-# Set logging file and format
-def log_to_file(message):
-    timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    log_message = f'{timestamp} - {message}\n'
-    
-    with open('logfile.log', 'a') as file:
-        file.write(log_message)
+# Every record of this run carries the same run id
+run_id = uuid.uuid4().hex
+
+# Log to the buffered run log, `fields` are stage, city_id, source and duration
+def log_to_file(message, level=logging.INFO, **fields):
+    log_event(message, level=level, run_id=run_id, **fields)
 
 # InfluxDB variables
 influx_bucket = str(os.getenv('INFLUXDB_BUCKET'))
@@ -31,61 +38,39 @@ influx_url = str(os.getenv('INFLUXDB_HOST'))
 
 # Retrieve city data from MariaDB
 def retrieve_city_data():
-    conn = pymysql.connect(
-        user=str(os.getenv('MYSQL_USER')),
-        password=str(os.getenv('MYSQL_PASSWORD')),
-        host=str(os.getenv('MYSQL_HOST')),
-        database=str(os.getenv('MYSQL_DB'))
-    )
-
-    cur = conn.cursor()
-    # Query the database for city data
-    cur.execute("SELECT city_id, active, name, lat, lon, tz, country, country_code, added, started, daily, hourly , icon, icon_15, gfs, meteofrance, horizon, comment, last_hit FROM cities")
-
-    city_data = cur.fetchall()
-    # Close database connections
-    cur.close()
-    conn.close()
+    with get_pool().connection() as conn:
+        cur = conn.cursor()
+        # Query the database for the due cities, next_run_utc is indexed
+        cur.execute("SELECT city_id, active, name, lat, lon, tz, country, country_code, added, started, daily, hourly , icon, icon_15, gfs, meteofrance, horizon, comment, last_hit FROM cities WHERE next_run_utc <= UTC_TIMESTAMP()")
+
+        city_data = cur.fetchall()
+        cur.close()
 
     return city_data
 
 # Retrieve query urls from MariaDB
 def retrieve_query_urls():
-    conn = pymysql.connect(
-        user=str(os.getenv('MYSQL_USER')),
-        password=str(os.getenv('MYSQL_PASSWORD')),
-        host=str(os.getenv('MYSQL_HOST')),
-        database=str(os.getenv('MYSQL_DB'))
-    )
-
-    cur = conn.cursor()
-    # Query the database for city data
-    cur.execute("SELECT query_urls_id, city_id, daily, hourly , icon, icon_15, gfs, meteofrance FROM query_urls")
-
-    query_urls = cur.fetchall()
-    # Close database connections
-    cur.close()
-    conn.close()
+    with get_pool().connection() as conn:
+        cur = conn.cursor()
+        # Query the database for city data
+        cur.execute("SELECT query_urls_id, city_id, daily, hourly , icon, icon_15, gfs, meteofrance FROM query_urls")
+
+        query_urls = cur.fetchall()
+        cur.close()
 
     return query_urls
 
 # Retrieve timezones from MariaDB
 def retrieve_tz_data():
-    conn = pymysql.connect(
-        user=str(os.getenv('MYSQL_USER')),
-        password=str(os.getenv('MYSQL_PASSWORD')),
-        host=str(os.getenv('MYSQL_HOST')),
-        database=str(os.getenv('MYSQL_DB'))
-    )
-    cur = conn.cursor()
+    with get_pool().connection() as conn:
+        cur = conn.cursor()
 
-    # Query the database for city data
-    cur.execute("SELECT city_id, lat, lon FROM cities WHERE tz IS NULL OR tz = ''")
+        # Query the database for city data
+        cur.execute("SELECT city_id, lat, lon FROM cities WHERE tz IS NULL OR tz = ''")
 
-    tz_data = cur.fetchall()
+        tz_data = cur.fetchall()
 
-    cur.close()
-    conn.close()
+        cur.close()
 
     return tz_data
 
@@ -94,482 +79,152 @@ def should_fetch_data(horizon, last_hit):
     """
     Returns True if the day difference between today and last_hit 
     is greater than or equal to horizon. Otherwise, it returns False.
+    Both are UTC dates, the clock last_hit is written in.
     """
-    today = datetime.datetime.today().date()
+    today = utc_today()
     days_difference = (today - last_hit).days
 
     return days_difference >= horizon
 
-def update_last_hit(city_id):
-    """Update the 'last_hit' column for a specific city in MariaDB."""
+def update_last_hit(city_ids):
+    """Update the 'last_hit' column of all ingested cities in MariaDB with one connection and one commit."""
 
-    conn = pymysql.connect(
-        user=str(os.getenv('MYSQL_USER')),
-        password=str(os.getenv('MYSQL_PASSWORD')),
-        host=str(os.getenv('MYSQL_HOST')),
-        database=str(os.getenv('MYSQL_DB'))
-    )
-    cursor = conn.cursor()
+    if not city_ids:
+        return
 
     try:
-        today = datetime.datetime.today().date() 
-        update_query = "UPDATE cities SET last_hit = %s WHERE city_id = %s"
-        cursor.execute(update_query, (today, city_id))
-        conn.commit()
+        with get_pool().connection() as conn:
+            mark_last_hit(conn, city_ids)
     except Exception as e:
-        log_to_file(f"Error updating last_hit for city_id: {city_id} - {e}")
-    finally:
-        cursor.close()
-        conn.close()
+        log_to_file(f"Error updating last_hit for city_ids: {sorted(city_ids)} - {e}", level=logging.ERROR, stage='last_hit')
 
 
+# Store the data of one source in InfluxDB, through the spool.
+# Returns False when InfluxDB did not take it and it waits in the spool,
+# with a batch writer the lines are only queued and their PendingWrite is returned
+def store_weather_data_in_influxdb(source, data, lat, lon, write_api, spool, writer=None):
+    lines = to_lines(source, data, lat, lon)
+    if writer is not None:
+        return writer.submit(lines)
+    return write_spooled(spool, write_api, influx_bucket, influx_org, lines)
 
-def is_it_23_local(utc_offset_seconds_str):
 
-    """Returns True if it's 23:00 local time based on the stored UTC offset in seconds"""
-    try:
-        utc_offset_seconds = int(utc_offset_seconds_str)
-    except ValueError:
-        return False
-
-    utc_now = datetime.datetime.utcnow()
-    local_time = utc_now + datetime.timedelta(seconds=utc_offset_seconds)
-    return local_time.hour == 23
-
-def local_offset():
-    """Get the local timezone offset in hours from UTC."""
-    offset_seconds = -time.altzone if time.localtime().tm_isdst else -time.timezone
-    return offset_seconds / 3600
-
-
-def date_to_unixtime(date_string):
-    # Specify the input date string
-    date_format = "%Y-%m-%d"
-    
-    # Convert the date string to a datetime object
-    date_object = datetime.datetime.strptime(date_string, date_format)
-
-    # Adjust the datetime object by the local timezone offset
-    date_object += datetime.timedelta(hours=local_offset())
-
-    # Convert the adjusted datetime object to Unix time
-    unix_time = int(date_object.timestamp())
-    return unix_time
-
-
-def time_to_unixtime(date_string):
-    # Specify the input date string format
-    date_format = "%Y-%m-%dT%H:%M"
-    
-    # Convert the date string to a datetime object
-    datetime_object = datetime.datetime.strptime(date_string, date_format)
-
-    # Adjust the datetime object by the local timezone offset
-    datetime_object += datetime.timedelta(hours=local_offset())
-
-    # Convert the adjusted datetime object to Unix time
-    unix_time = int(datetime_object.timestamp())
-    return unix_time
-
-
-
-# Fetch weather data from open-meteo
-def fetch_weather_data(url):
-    response = requests.get(url)
-    data = response.json()
-    return data
-
-# Fetch daily weather data from open-meteo
-def fetch_daily_data(lat, lon, horizon):
-    horizon = horizon + 1
-    url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&daily=temperature_2m_max,temperature_2m_min,windspeed_10m_max,winddirection_10m_dominant,shortwave_radiation_sum&timezone=auto&forecast_days={horizon}"
-    print(url)
-    return fetch_weather_data(url)
-# Fetch hourly weather data from open-meteo
-def fetch_hourly_data(lat, lon, horizon):
-    horizon = horizon + 1
-    url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&hourly=temperature_2m,relativehumidity_2m,windspeed_10m,windspeed_80m,windspeed_120m,windspeed_180m,winddirection_10m,winddirection_80m,winddirection_120m,winddirection_180m,windgusts_10m,temperature_80m,temperature_120m,temperature_180m,shortwave_radiation,direct_radiation,diffuse_radiation&forecast_days=2&timezone=auto&forecast_days={horizon}"
-    print(url)
-    return fetch_weather_data(url)
-# Fetch icon hourly weather data from open-meteo
-def fetch_icon_data(lat, lon, horizon):
-    horizon = horizon + 1
-    url = f"https://api.open-meteo.com/v1/dwd-icon?latitude={lat}&longitude={lon}&hourly=temperature_2m,relativehumidity_2m,windspeed_10m,windspeed_80m,windspeed_120m,windspeed_180m,winddirection_10m,winddirection_80m,winddirection_120m,winddirection_180m,windgusts_10m,temperature_80m,temperature_120m,temperature_180m,shortwave_radiation,direct_radiation,diffuse_radiation,direct_normal_irradiance,terrestrial_radiation&timezone=auto&forecast_days={horizon}"
-    print(url)
-    return fetch_weather_data(url)
-# Fetch icon minutely_15 weather data from open-meteo
-def fetch_icon_15_data(lat, lon, horizon):
-    horizon = horizon + 1
-    url = f"https://api.open-meteo.com/v1/dwd-icon?latitude={lat}&longitude={lon}&minutely_15=shortwave_radiation,direct_radiation,diffuse_radiation,direct_normal_irradiance,terrestrial_radiation&timezone=auto&forecast_days={horizon}"
-    print(url)
-    return fetch_weather_data(url)
-# Fetch gfs hourly weather data from open-meteo
-def fetch_gfs_data(lat, lon, horizon):
-    horizon = horizon + 1
-    url = f"https://api.open-meteo.com/v1/gfs?latitude={lat}&longitude={lon}&hourly=temperature_2m,relativehumidity_2m,windspeed_10m,windspeed_80m,winddirection_10m,winddirection_80m,windgusts_10m,shortwave_radiation,direct_radiation,diffuse_radiation,direct_normal_irradiance,terrestrial_radiation&forecast_days=2&timezone=auto&forecast_days={horizon}"
-    print(url)
-    return fetch_weather_data(url)
-# Fetch meteofrance hourly weather data from open-meteo
-def fetch_meteofrance_data(lat, lon, horizon):
-    horizon = horizon + 1
-    url = f"https://api.open-meteo.com/v1/meteofrance?latitude={lat}&longitude={lon}&hourly=temperature_2m,relativehumidity_2m,windspeed_10m,winddirection_10m,windgusts_10m,shortwave_radiation,direct_radiation,diffuse_radiation,direct_normal_irradiance,terrestrial_radiation&forecast_days=2&timezone=auto&forecast_days={horizon}"
-    print(url)
-    return fetch_weather_data(url)
-
-
-# Store daily data in InfluxDB
-def store_daily_data_in_influxdb(data, lat, lon, write_api): # daily data from open-meteo
-    #get data
-    timestamps = data["daily"]["time"][1:]
-    temp_min_s = data["daily"]["temperature_2m_min"][1:]
-    temp_max_s = data["daily"]["temperature_2m_max"][1:]
-    wind_max_s = data["daily"]["windspeed_10m_max"][1:]
-    wind_dir_s = data["daily"]["winddirection_10m_dominant"][1:]
-    radiation_s = data["daily"]["shortwave_radiation_sum"][1:]
-    #add coordinates
-    coordinates = lat,lon
-
-    for timestamp_str, temp_min, temp_max, \
-        wind_max, wind_dir, radiation, \
-        in zip(timestamps, temp_min_s, temp_max_s, \
-               wind_max_s, wind_dir_s, radiation_s):
-        
-        unix_time = date_to_unixtime(timestamp_str)
-
-        write_api.write(influx_bucket, influx_org, [
-            Point("daily_forecast")
-            .tag("coordinates", coordinates)
-            .field("temparature_min_C", temp_min)
-            .field("temparature_max_C", temp_max)
-            .field("shortwave_radiation_sum", radiation)
-            .field("wind_speed", wind_max)
-            .field("wind_direction", wind_dir)
-            .time(unix_time, write_precision='s')
-        ])
-
-# Store hourly data in InfluxDB
-def store_hourly_data_in_influxdb(data2, lat, lon, write_api): # hourly data from open-meteo
-
-    coordinates = lat,lon
-
-    timestamps = data2["hourly"]["time"][24:]
-
-    temperatures = data2["hourly"]["temperature_2m"][24:]
-    humidities = data2["hourly"]["relativehumidity_2m"][24:]
-    windspeed_10m_s = data2["hourly"]["windspeed_10m"][24:]
-    windspeed_80m_s = data2["hourly"]["windspeed_80m"][24:]
-    windspeed_120m_s = data2["hourly"]["windspeed_120m"][24:]
-    windspeed_180m_s = data2["hourly"]["windspeed_180m"][24:]
-    winddirection_10m_s = data2["hourly"]["winddirection_10m"][24:]
-    winddirection_80m_s = data2["hourly"]["winddirection_80m"][24:]
-    winddirection_120m_s = data2["hourly"]["winddirection_120m"][24:]
-    winddirection_180m_s = data2["hourly"]["winddirection_180m"][24:]
-    temperature_80m_s = data2["hourly"]["temperature_80m"][24:]
-    temperature_120m_s = data2["hourly"]["temperature_120m"][24:]
-    temperature_180m_s = data2["hourly"]["temperature_180m"][24:]
-    shortwave_radiation_s = data2["hourly"]["shortwave_radiation"][24:]
-    direct_radiation_s = data2["hourly"]["direct_radiation"][24:]
-    diffuse_radiation_s = data2["hourly"]["diffuse_radiation"][24:]
-
-    for timestamp_str, temperature, humidity, \
-        windspeed_10m, windspeed_80m, windspeed_120m, windspeed_180m, \
-        winddirection_10m, winddirection_80m, winddirection_120m, winddirection_180m, \
-        temperature_80m, temperature_120m, temperature_180m, \
-        shortwave_radiation, direct_radiation, diffuse_radiation, \
-        in zip(timestamps, temperatures, humidities, \
-               windspeed_10m_s, windspeed_80m_s, windspeed_120m_s, windspeed_180m_s, \
-                winddirection_10m_s, winddirection_80m_s, winddirection_120m_s, winddirection_180m_s, \
-                temperature_80m_s, temperature_120m_s, temperature_180m_s, \
-                shortwave_radiation_s, direct_radiation_s, diffuse_radiation_s):
-        
-        unix_time = time_to_unixtime(timestamp_str)
-
-        write_api.write(influx_bucket, influx_org, [
-            # Create a Point with the measurement name
-            Point("hourly_forecast")
-            .tag("coordinates", coordinates)
-            .field("temperature", temperature)
-            .field("humidity", humidity)
-            .field("windspeed_10m", windspeed_10m)
-            .field("windspeed_80m", windspeed_80m)
-            .field("windspeed_120m", windspeed_120m)
-            .field("windspeed_180m", windspeed_180m)
-            .field("winddirection_10m", winddirection_10m)
-            .field("winddirection_80m", winddirection_80m)
-            .field("winddirection_120m", winddirection_120m)
-            .field("winddirection_180m", winddirection_180m)
-            .field("temperature_80m", temperature_80m)
-            .field("temperature_120m", temperature_120m)
-            .field("temperature_180m", temperature_180m) 
-            .field("shortwave_radiation", shortwave_radiation)
-            .field("direct_radiation", direct_radiation)
-            .field("diffuse_radiation", diffuse_radiation)
-
-            # Set the timestamp for the Point
-            .time(unix_time, write_precision='s')
-        ])
-
-# Store icon hourly data in InfluxDB
-def store_icon_data_in_influxdb(data3, lat, lon, write_api): # icon hourly data from open-meteo
-
-    coordinates = lat,lon
-
-    timestamps = data3["hourly"]["time"][24:]
-
-    temperatures = data3["hourly"]["temperature_2m"][24:]
-    humidities = data3["hourly"]["relativehumidity_2m"][24:]
-    windspeed_10m_s = data3["hourly"]["windspeed_10m"][24:]
-    windspeed_80m_s = data3["hourly"]["windspeed_80m"][24:]
-    windspeed_120m_s = data3["hourly"]["windspeed_120m"][24:]
-    windspeed_180m_s = data3["hourly"]["windspeed_180m"][24:]
-    winddirection_10m_s = data3["hourly"]["winddirection_10m"][24:]
-    winddirection_80m_s = data3["hourly"]["winddirection_80m"][24:]
-    winddirection_120m_s = data3["hourly"]["winddirection_120m"][24:]
-    winddirection_180m_s = data3["hourly"]["winddirection_180m"][24:]
-    windgusts_10m_s = data3["hourly"]["windgusts_10m"][24:]
-    temperature_80m_s = data3["hourly"]["temperature_80m"][24:]
-    temperature_120m_s = data3["hourly"]["temperature_120m"][24:]
-    temperature_180m_s = data3["hourly"]["temperature_180m"][24:]
-    shortwave_radiation_s = data3["hourly"]["shortwave_radiation"][24:]
-    direct_radiation_s = data3["hourly"]["direct_radiation"][24:]
-    diffuse_radiation_s = data3["hourly"]["diffuse_radiation"][24:]
-    direct_normal_irradiance_s = data3["hourly"]["direct_normal_irradiance"][24:]
-    terrestrial_radiation_s = data3["hourly"]["terrestrial_radiation"][24:]
-
-    for timestamp_str, temperature, humidity, \
-        windspeed_10m, windspeed_80m, windspeed_120m, windspeed_180m, \
-        winddirection_10m, winddirection_80m, winddirection_120m, winddirection_180m, windgusts_10m, \
-        temperature_80m, temperature_120m, temperature_180m, \
-        shortwave_radiation, direct_radiation, diffuse_radiation, direct_normal_irradiance, terrestrial_radiation \
-        in zip(timestamps, temperatures, humidities, \
-               windspeed_10m_s, windspeed_80m_s, windspeed_120m_s, windspeed_180m_s, \
-                winddirection_10m_s, winddirection_80m_s, winddirection_120m_s, winddirection_180m_s, windgusts_10m_s, \
-                temperature_80m_s, temperature_120m_s, temperature_180m_s, \
-                shortwave_radiation_s, direct_radiation_s, diffuse_radiation_s, direct_normal_irradiance_s, terrestrial_radiation_s):
-        
-        unix_time = time_to_unixtime(timestamp_str)
-
-        write_api.write(influx_bucket, influx_org, [
-            # Create a Point with the measurement name
-            Point("icon_forecast")
-            .tag("coordinates", coordinates)
-            .field("temperature", temperature)
-            .field("humidity", humidity)
-            .field("windspeed_10m", windspeed_10m)
-            .field("windspeed_80m", windspeed_80m)
-            .field("windspeed_120m", windspeed_120m)
-            .field("windspeed_180m", windspeed_180m)
-            .field("winddirection_10m", winddirection_10m)
-            .field("winddirection_80m", winddirection_80m)
-            .field("winddirection_120m", winddirection_120m)
-            .field("winddirection_180m", winddirection_180m)
-            .field("windgusts_10m", windgusts_10m)
-            .field("temperature_80m", temperature_80m)
-            .field("temperature_120m", temperature_120m)
-            .field("temperature_180m", temperature_180m) 
-            .field("shortwave_radiation", shortwave_radiation)
-            .field("direct_radiation", direct_radiation)
-            .field("diffuse_radiation", diffuse_radiation)
-            .field("direct_normal_irradiance", direct_normal_irradiance)
-            .field("terrestrial_radiation", terrestrial_radiation)
-
-            # Set the timestamp for the Point
-            .time(unix_time, write_precision='s')
-        ])
-
-# Store icon minutely_15 data in InfluxDB
-def store_icon_15_data_in_influxdb(data4, lat, lon, write_api): # icon minutely_15 data from open-meteo
-
-    coordinates = lat,lon
-
-    timestamps = data4["minutely_15"]["time"][96:]
-
-    shortwave_radiation_s = data4["minutely_15"]["shortwave_radiation"][96:]
-    direct_radiation_s = data4["minutely_15"]["direct_radiation"][96:]
-    diffuse_radiation_s = data4["minutely_15"]["diffuse_radiation"][96:]
-    direct_normal_irradiance_s = data4["minutely_15"]["direct_normal_irradiance"][96:]
-    terrestrial_radiation_s = data4["minutely_15"]["terrestrial_radiation"][96:]
-
-    for timestamp_str, shortwave_radiation, direct_radiation, diffuse_radiation, direct_normal_irradiance, terrestrial_radiation \
-        in zip(timestamps, shortwave_radiation_s, direct_radiation_s, diffuse_radiation_s, direct_normal_irradiance_s, terrestrial_radiation_s):
-        
-        unix_time = time_to_unixtime(timestamp_str)
-
-        write_api.write(influx_bucket, influx_org, [
-            # Create a Point with the measurement name
-            Point("icon_15_forecast")
-            .tag("coordinates", coordinates)
-            .field("shortwave_radiation", shortwave_radiation)
-            .field("direct_radiation", direct_radiation)
-            .field("diffuse_radiation", diffuse_radiation)
-            .field("direct_normal_irradiance", direct_normal_irradiance)
-            .field("terrestrial_radiation", terrestrial_radiation)
-
-            # Set the timestamp for the Point
-            .time(unix_time, write_precision='s')
-        ])
-
-# Store gfs hourly data in InfluxDB
-def store_gfs_data_in_influxdb(data5, lat, lon, write_api): # hourly data from open-meteo
-
-    coordinates = lat,lon
-
-    timestamps = data5["hourly"]["time"][24:]
-
-    temperatures = data5["hourly"]["temperature_2m"][24:]
-    humidities = data5["hourly"]["relativehumidity_2m"][24:]
-    windspeed_10m_s = data5["hourly"]["windspeed_10m"][24:]
-    windspeed_80m_s = data5["hourly"]["windspeed_80m"][24:]
-    winddirection_10m_s = data5["hourly"]["winddirection_10m"][24:]
-    winddirection_80m_s = data5["hourly"]["winddirection_80m"][24:]
-    windgusts_10m_s = data5["hourly"]["windgusts_10m"][24:]
-    shortwave_radiation_s = data5["hourly"]["shortwave_radiation"][24:]
-    direct_radiation_s = data5["hourly"]["direct_radiation"][24:]
-    diffuse_radiation_s = data5["hourly"]["diffuse_radiation"][24:]
-    direct_normal_irradiance_s = data5["hourly"]["direct_normal_irradiance"][24:]
-    terrestrial_radiation_s = data5["hourly"]["terrestrial_radiation"][24:]
-
-    for timestamp_str, temperature, humidity, \
-        windspeed_10m, windspeed_80m, winddirection_10m, winddirection_80m, windgusts_10m, \
-        shortwave_radiation, direct_radiation, diffuse_radiation, direct_normal_irradiance, terrestrial_radiation\
-        in zip(timestamps, temperatures, humidities, windspeed_10m_s, windspeed_80m_s, winddirection_10m_s, winddirection_80m_s, windgusts_10m_s, \
-               shortwave_radiation_s, direct_radiation_s, diffuse_radiation_s, direct_normal_irradiance_s, terrestrial_radiation_s):
-        
-
-        unix_time = time_to_unixtime(timestamp_str)
-
-        write_api.write(influx_bucket, influx_org, [    
-            # Create a Point with the measurement name
-            Point("gfs_forecast")
-            .tag("coordinates", coordinates)
-            .field("temperature", temperature)
-            .field("humidity", humidity)
-            .field("windspeed_10m", windspeed_10m)
-            .field("windspeed_80m", windspeed_80m)
-            .field("winddirection_10m", winddirection_10m)
-            .field("winddirection_80m", winddirection_80m)
-            .field("winddirection_80m", windgusts_10m)
-            .field("shortwave_radiation", shortwave_radiation)
-            .field("direct_radiation", direct_radiation)
-            .field("diffuse_radiation", diffuse_radiation)
-            .field("direct_normal_irradiance", direct_normal_irradiance)
-            .field("terrestrial_radiation", terrestrial_radiation)
-
-            # Set the timestamp for the Point
-            .time(unix_time, write_precision='s')
-        ])
-
-# Store meteofrance hourly data in InfluxDB
-def store_meteofrance_data_in_influxdb(data6, lat, lon, write_api): # hourly data from open-meteo
-
-    coordinates = lat,lon
-
-    timestamps = data6["hourly"]["time"][24:]
-
-    temperatures = data6["hourly"]["temperature_2m"][24:]
-    humidities = data6["hourly"]["relativehumidity_2m"][24:]
-    windspeed_10m_s = data6["hourly"]["windspeed_10m"][24:]
-    winddirection_10m_s = data6["hourly"]["winddirection_10m"][24:]
-    windgusts_10m_s = data6["hourly"]["windgusts_10m"][24:]
-    shortwave_radiation_s = data6["hourly"]["shortwave_radiation"][24:]
-    direct_radiation_s = data6["hourly"]["direct_radiation"][24:]
-    diffuse_radiation_s = data6["hourly"]["diffuse_radiation"][24:]
-    direct_normal_irradiance_s = data6["hourly"]["direct_normal_irradiance"][24:]
-    terrestrial_radiation_s = data6["hourly"]["terrestrial_radiation"][24:]
-
-    for timestamp_str, temperature, humidity, \
-        windspeed_10m, winddirection_10m, windgusts_10m, \
-        shortwave_radiation, direct_radiation, diffuse_radiation, direct_normal_irradiance, terrestrial_radiation\
-        in zip(timestamps, temperatures, humidities, windspeed_10m_s, winddirection_10m_s, windgusts_10m_s, \
-               shortwave_radiation_s, direct_radiation_s, diffuse_radiation_s, direct_normal_irradiance_s, terrestrial_radiation_s):
-        
-        unix_time = time_to_unixtime(timestamp_str)
-
-        write_api.write(influx_bucket, influx_org, [
-            # Create a Point with the measurement name
-            Point("meteofrance_forecast")
-            .tag("coordinates", coordinates)
-            .field("temperature", temperature)
-            .field("humidity", humidity)
-            .field("windspeed_10m", windspeed_10m)
-            .field("winddirection_10m", winddirection_10m)
-            .field("winddirection_80m", windgusts_10m)
-            .field("shortwave_radiation", shortwave_radiation)
-            .field("direct_radiation", direct_radiation)
-            .field("diffuse_radiation", diffuse_radiation)
-            .field("direct_normal_irradiance", direct_normal_irradiance)
-            .field("terrestrial_radiation", terrestrial_radiation)
-
-            # Set the timestamp for the Point
-            .time(unix_time, write_precision='s')
-        ])
+# Log how a store of one source ended: written, spooled (the city stays due) or never confirmed
+def log_stored(source, city, written, duration):
+    city_id, name, lat, lon, tz, horizon = city
+    label = SOURCES[source]['label']
+    if written is None:
+        log_to_file(f"{label} Data for {name} with {lat},{lon} not confirmed", level=logging.ERROR, stage='store', city_id=city_id, source=source)
+    elif written:
+        log_to_file(f"{label} Data for {name} with {lat},{lon} Stored", stage='store', city_id=city_id, source=source, duration=duration)
+    else:
+        log_to_file(f"{label} Data for {name} with {lat},{lon} Spooled, the city stays due", level=logging.WARNING, stage='store', city_id=city_id, source=source, duration=duration)
 
 
 def fetch_and_store_weather_data():
 
     # Connect to InfluxDB
-    client = InfluxDBClient(url=influx_url, token=influx_token)
+    client = influx_client(influx_url, influx_token)
     write_api = client.write_api(write_options=SYNCHRONOUS)
 
+    # Replay what earlier runs could not write, before writing anything newer
+    spool = Spool()
+    replayed = spool.drain(write_api)
+    log_to_file(f"Replayed {replayed} spooled records", stage='drain')
+
+    # In batch mode the writes run in the background while the run goes on
+    writer = BatchWriter(write_api, influx_bucket, influx_org, spool) if write_mode() == 'batch' else None
+
+    # Follow DST changes before picking the due cities, resolved offline
+    with get_pool().connection() as conn:
+        refreshed = refresh_offsets(conn)
+    log_to_file(f"Updated the timezone offset of {refreshed} cities", stage='plan')
+
     # Retrieve city data from MariaDB
     city_data = retrieve_city_data()
 
-    # Loop through each city and fetch weather data
+    # Collect every enabled source of every due city
+    jobs = []
     for row in city_data:
         city_id, active, name, lat, lon, tz, country, country_code, added, started, daily, hourly , icon, icon_15, gfs, meteofrance, horizon, comment, last_hit = row
 
-        # Check if localtime is 23:00
-        if not is_it_23_local(tz):
-            log_to_file(f"Data collection skipped for {name} as localtime is not 23:00")
-            continue 
-        
+        # A due city is collected at its 23:00 or, when that run missed it, by the next hourly run
         # Check if city is active
         if active == 0:
-            log_to_file(f"Data collection skipped for {name} as it is not active")
+            log_to_file(f"Data collection skipped for {name} as it is not active", stage='plan', city_id=city_id)
             continue
 
         if not should_fetch_data(horizon, last_hit):
-            log_to_file(f"Data collection skipped for {name} as horizon criteria is not met")
+            log_to_file(f"Data collection skipped for {name} as horizon criteria is not met", stage='plan', city_id=city_id)
             continue
 
-        try:
-
-            if daily == 1:
-                data = fetch_daily_data(lat, lon, horizon)
-                store_daily_data_in_influxdb(data, lat, lon, write_api)
-                log_to_file(f"Daily Data for {name} with {lat},{lon} Stored")
-                update_last_hit(city_id)
-            if hourly == 1:
-                data2 = fetch_hourly_data(lat, lon, horizon)
-                store_hourly_data_in_influxdb(data2, lat, lon, write_api)
-                log_to_file(f"Hourly Data for {name} with {lat},{lon} Stored")
-                update_last_hit(city_id)
-            if icon == 1:
-                data3 = fetch_icon_data(lat, lon, horizon)
-                store_icon_data_in_influxdb(data3, lat, lon, write_api)
-                log_to_file(f"ICON Data for {name} with {lat},{lon} Stored")
-                update_last_hit(city_id)
-            if icon_15 == 1:
-                data4 = fetch_icon_15_data(lat, lon, horizon)
-                store_icon_15_data_in_influxdb(data4, lat, lon, write_api)
-                log_to_file(f"ICON 15 Data for {name} with {lat},{lon} Stored")
-                update_last_hit(city_id)
-            if gfs == 1:
-                data5 = fetch_gfs_data(lat, lon, horizon)
-                store_gfs_data_in_influxdb(data5, lat, lon, write_api)
-                log_to_file(f"GFS Data for {name} with {lat},{lon} Stored")
-                update_last_hit(city_id)
-            if meteofrance == 1:
-                data6 = fetch_meteofrance_data(lat, lon, horizon)
-                store_meteofrance_data_in_influxdb(data6, lat, lon, write_api)
-                log_to_file(f"Meteofrance Data for {name} with {lat},{lon} Stored")
-                update_last_hit(city_id)
-
-        except Exception as e:
-            logging.error(f"Error fetching weather data for {name} from API: {str(e)}")
+        city = (city_id, name, lat, lon, tz, horizon)
+        enabled = {'daily': daily, 'hourly': hourly, 'icon': icon, 'icon_15': icon_15, 'gfs': gfs, 'meteofrance': meteofrance}
+        for source in SOURCES:
+            if enabled[source] == 1:
+                jobs.append((source, city))
+
+    # Jobs sharing source, horizon and timezone are fetched with one multi-location call
+    groups = plan_groups(jobs, key=lambda job: (job[0], job[1][5], job[1][4]))
+    urls = []
+    for group in groups:
+        source, city = group[0]
+        lats, lons = join_coordinates([(city[2], city[3]) for source, city in group])
+        urls.append(source_url(source, lats, lons, city[5]))
+
+    # Fetch all planned urls concurrently, results come back in the planned order
+    # and each group is stored as soon as it is in
+    fetch_start = time.time()
+    results = fetch_all(urls)
+
+    # (city_id, written) of every store, last_hit only moves for cities whose writes all landed
+    writes = []
+    # Batched writes of this run, settled once the writer is flushed
+    submitted = []
+    for group, data in zip(groups, results):
+        for (source, city), payload in zip(group, split_response(data, len(group))):
+            city_id, name, lat, lon, tz, horizon = city
+            label = SOURCES[source]['label']
+
+            if isinstance(payload, BudgetExceeded):
+                # Not stored so the city stays due, a later run collects it
+                log_to_file(f"{label} Data for {name} deferred, {payload}", level=logging.WARNING, stage='fetch', city_id=city_id, source=source)
+                continue
+
+            if isinstance(payload, Exception):
+                log_to_file(f"Error fetching {label} weather data for {name} from API: {str(payload)}", level=logging.ERROR, stage='fetch', city_id=city_id, source=source)
+                continue
+
+            try:
+                store_start = time.time()
+                written = store_weather_data_in_influxdb(source, payload, lat, lon, write_api, spool, writer)
+                if writer is not None:
+                    submitted.append((written, source, city, store_start))
+                    continue
+                log_stored(source, city, written, round(time.time() - store_start, 3))
+                writes.append((city_id, written))
+            except Exception as e:
+                log_to_file(f"Error storing {label} weather data for {name}: {str(e)}", level=logging.ERROR, stage='store', city_id=city_id, source=source)
+                writes.append((city_id, None))
+
+    log_to_file(f"Fetched {len(urls)} urls", stage='fetch', duration=round(time.time() - fetch_start, 3))
+
+    if writer is not None:
+        # Wait until every batched write is written or spooled
+        if not writer.close(timeout=float(os.getenv('INFLUX_FLUSH_TIMEOUT') or 300)):
+            log_to_file("InfluxDB writer did not finish in time, unconfirmed cities stay due", level=logging.ERROR, stage='store')
+        for write, source, city, store_start in submitted:
+            duration = None if write.resolved_at is None else round(write.resolved_at - store_start, 3)
+            log_stored(source, city, write.written, duration)
+            writes.append((city[0], write.written))
+
+    stored = confirmed_cities(writes)
+    update_last_hit(stored)
+    log_to_file(f"Open-Meteo budget left: {remaining()}", stage='run')
 
     # close database connections
     client.close()
+    get_pool().close()
 
 
 fetch_and_store_weather_data()
@@ -577,4 +232,4 @@ fetch_and_store_weather_data()
 # Calculate elapsed time
 end_time = time.time()
 elapsed_time = end_time - start_time
-log_to_file(f"Elapsed Time: {elapsed_time} seconds")
\ No newline at end of file
+log_to_file(f"Elapsed Time: {elapsed_time} seconds", stage='run', duration=round(elapsed_time, 3))
\ No newline at end of file
@@ -0,0 +1,14 @@
+from setuptools import setup
+
+setup(
+    name="weather-ingest",
+    packages=["ingest"],
+    install_requires=[
+        "influxdb-client",
+        "numpy",
+        "PyMySQL",
+        "requests",
+        "timezonefinder",
+        "tzdata",
+    ],
+)
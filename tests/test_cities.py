@@ -0,0 +1,117 @@
+import datetime
+import time
+import types
+
+import pytest
+
+from ingest import cities
+
+
+class RunClock(datetime.datetime):
+    """A clock stopped at `run`, local times follow the TZ of the process."""
+
+    run = None
+
+    @classmethod
+    def now(cls, tz=None):
+        if tz is None:
+            return cls.run.astimezone().replace(tzinfo=None)
+        return cls.run.astimezone(tz)
+
+    @classmethod
+    def today(cls):
+        return cls.now()
+
+
+class Recorder:
+    """Records the statements of mark_last_hit instead of running them."""
+
+    def __init__(self):
+        self.executed = []
+        self.committed = False
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, params=None):
+        self.executed.append((query, params))
+
+    def executemany(self, query, rows):
+        pass
+
+    def commit(self):
+        self.committed = True
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def athens_host(monkeypatch):
+    monkeypatch.setenv("TZ", "Europe/Athens")
+    time.tzset()
+    monkeypatch.setattr(cities, "datetime", types.SimpleNamespace(datetime=RunClock, timezone=datetime.timezone, timedelta=datetime.timedelta, time=datetime.time))
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_next_run_utc_expression():
+    # The SQL is built from the same constants as next_run_utc()
+    assert "DATE_ADD(last_hit, INTERVAL horizon DAY)" in cities.NEXT_RUN_UTC
+    assert "MOD(82800 - NULLIF(tz, '') + 172800, 86400)" in cities.NEXT_RUN_UTC
+
+
+# Kiritimati, Los Angeles in summer, Athens in summer and Tokyo
+@pytest.mark.parametrize("hours, due", [
+    (14, datetime.datetime(2024, 7, 16, 9, 0)),
+    (-7, datetime.datetime(2024, 7, 16, 6, 0)),
+    (3, datetime.datetime(2024, 7, 16, 20, 0)),
+    (9, datetime.datetime(2024, 7, 16, 14, 0)),
+])
+def test_next_run_utc(hours, due):
+    tz = hours * 3600
+    assert cities.next_run_utc(datetime.date(2024, 7, 15), 1, tz) == due
+    assert cities.next_run_utc(datetime.date(2024, 7, 15), 1, str(tz)) == due
+    # It is the city's local 23:00, the first one after UTC midnight of the due date
+    local = due + datetime.timedelta(seconds=tz)
+    assert local.hour == 23
+    assert datetime.timedelta(0) <= due - datetime.datetime(2024, 7, 16) < datetime.timedelta(days=1)
+
+
+def test_next_run_utc_without_tz_or_last_hit():
+    assert cities.next_run_utc(datetime.date(2024, 7, 15), 1, '') is None
+    assert cities.next_run_utc(None, 1, 3600) is None
+
+
+# London in summer, Athens itself, Tokyo and Los Angeles
+@pytest.mark.parametrize("tz", [3600, 10800, 32400, -25200])
+def test_mark_last_hit_east_of_utc_host(athens_host, tz):
+    # The run at the city's local 23:00 of 2024-07-15
+    run = datetime.datetime(2024, 7, 15, 23, 0) - datetime.timedelta(seconds=tz)
+    RunClock.run = run.replace(tzinfo=datetime.timezone.utc)
+
+    conn = Recorder()
+    assert cities.mark_last_hit(conn, [1]) == 1
+    assert conn.committed
+
+    query, params = conn.executed[0]
+    assert cities.NEXT_RUN_UTC in query
+
+    # With a horizon of one day the city is due again at its next local 23:00
+    assert cities.next_run_utc(params[0], 1, tz) - run == datetime.timedelta(days=1)
+
+
+def test_host_date_is_ahead(athens_host):
+    # At 22:00 UTC the host's local date is already the next day, last_hit is not
+    RunClock.run = datetime.datetime(2024, 7, 15, 22, 0, tzinfo=datetime.timezone.utc)
+    assert RunClock.today().date() == datetime.date(2024, 7, 16)
+    assert cities.utc_today() == datetime.date(2024, 7, 15)
+
+
+def test_confirmed_cities_holds_spooled_and_unconfirmed():
+    writes = [(1, True), (2, False), (3, None), (1, True), (4, True), (4, False)]
+    assert cities.confirmed_cities(writes) == [1]
@@ -0,0 +1,27 @@
+import threading
+
+from ingest import fetch
+
+
+def test_fetch_all_yields_in_order_before_the_last_is_in(monkeypatch):
+    release = threading.Event()
+
+    def fake_fetch(url, timeout):
+        if url == 'slow':
+            release.wait(5)
+        if url == 'bad':
+            raise ValueError(url)
+        return {'url': url}
+
+    monkeypatch.setattr(fetch, 'fetch_json', fake_fetch)
+    results = fetch.fetch_all(['a', 'bad', 'b', 'slow'], max_in_flight=4)
+    assert next(results) == {'url': 'a'}
+    assert isinstance(next(results), ValueError)
+    assert next(results) == {'url': 'b'}
+    # The first results were handed out while the last request was still open
+    release.set()
+    assert list(results) == [{'url': 'slow'}]
+
+
+def test_fetch_all_without_urls():
+    assert list(fetch.fetch_all([])) == []
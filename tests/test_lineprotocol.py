@@ -0,0 +1,77 @@
+import datetime
+
+import numpy as np
+import pytest
+from influxdb_client import Point
+
+from ingest.lineprotocol import to_lines
+from ingest.sources import SOURCES, to_epoch_seconds, first_row
+
+
+# Step between the timestamps of each section and how they are written
+STEPS = {'daily': (datetime.timedelta(days=1), '%Y-%m-%d'), 'hourly': (datetime.timedelta(hours=1), '%Y-%m-%dT%H:%M'), 'minutely_15': (datetime.timedelta(minutes=15), '%Y-%m-%dT%H:%M')}
+
+
+# Rows of the first day, the ones the 23:00 run cuts off
+FIRST_DAY_ROWS = {'daily': 1, 'hourly': 24, 'minutely_15': 96}
+# The 23:00 run of the payloads below (UTC+2)
+RUN_AT = datetime.datetime(2024, 3, 30, 21, 0, tzinfo=datetime.timezone.utc).timestamp()
+
+
+def payload(source, rows):
+    spec = SOURCES[source]
+    step, fmt = STEPS[spec['section']]
+    start = datetime.datetime(2024, 3, 30)
+    block = {'time': [(start + step * row).strftime(fmt) for row in range(rows)]}
+    for i, variable in enumerate(spec['fields'].values()):
+        # Floats, integral floats, ints and gaps
+        block[variable] = [None if (row + i) % 7 == 0 else (row * 1.5 - i if i % 3 else row + i) for row in range(rows)]
+    return {'utc_offset_seconds': 7200, spec['section']: block}
+
+
+def point_lines(source, data, lat, lon):
+    # What building a Point per row gave
+    spec = SOURCES[source]
+    block = data[spec['section']]
+    skip = FIRST_DAY_ROWS[spec['section']]
+    columns = [block[variable][skip:] for variable in spec['fields'].values()]
+    lines = []
+    for unix_time, values in zip(to_epoch_seconds(block['time'][skip:]).tolist(), zip(*columns)):
+        point = Point(spec['measurement']).tag("coordinates", str((lat, lon)))
+        for name, value in zip(spec['fields'], values):
+            point = point.field(name, value)
+        line = point.time(unix_time, write_precision='s').to_line_protocol()
+        if line:
+            lines.append(line)
+    return lines
+
+
+@pytest.mark.parametrize("source", list(SOURCES))
+def test_to_lines_matches_point(source):
+    data = payload(source, FIRST_DAY_ROWS[SOURCES[source]['section']] + 48)
+    assert to_lines(source, data, 37.98, 23.72, now=RUN_AT) == point_lines(source, data, 37.98, 23.72)
+
+
+def test_to_lines_reads_numpy_columns():
+    data = payload('hourly', 72)
+    block = data['hourly']
+    for variable in SOURCES['hourly']['fields'].values():
+        block[variable] = np.ma.masked_invalid(np.array([np.nan if value is None else value for value in block[variable]], dtype=float))
+    plain = payload('hourly', 72)
+    for variable in SOURCES['hourly']['fields'].values():
+        plain['hourly'][variable] = [None if value is None else float(value) for value in plain['hourly'][variable]]
+    assert to_lines('hourly', data, 1.0, 2.0, now=RUN_AT) == to_lines('hourly', plain, 1.0, 2.0, now=RUN_AT)
+
+
+@pytest.mark.parametrize("hour, day", [
+    # The 23:00 run stores from tomorrow
+    ((2024, 3, 30, 23), '2024-03-31'),
+    # A city picked up late, after its midnight, keeps the day it was due for
+    ((2024, 3, 31, 3), '2024-03-31'),
+    ((2024, 3, 31, 22), '2024-03-31'),
+])
+def test_first_row_is_the_day_after_the_due_run(hour, day):
+    times = [(datetime.datetime(2024, 3, 30) + datetime.timedelta(hours=h)).strftime('%Y-%m-%dT%H:%M') for h in range(72)]
+    local = datetime.datetime(*hour, tzinfo=datetime.timezone(datetime.timedelta(hours=2)))
+    first = first_row(to_epoch_seconds(times), 7200, now=local.timestamp())
+    assert times[first] == f"{day}T00:00"
@@ -0,0 +1,78 @@
+import json
+
+import pytest
+
+from ingest import ratelimit
+
+URL = "https://api.open-meteo.com/v1/forecast?latitude=1,2&longitude=3,4&hourly=temperature_2m&forecast_days=2"
+
+
+class Clock:
+    """time.time and time.sleep of the rate limiter, sleeping moves the clock."""
+
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(tmp_path, monkeypatch):
+    monkeypatch.setenv('RATE_LIMIT_STATE', str(tmp_path / 'ratelimit.json'))
+    monkeypatch.setenv('RATE_LIMITS', json.dumps({'api.open-meteo.com': {'minute': 10, 'hour': 30, 'day': 40}}))
+    monkeypatch.setenv('RATE_LIMIT_MAX_WAIT', '60')
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, 'time', clock.time)
+    monkeypatch.setattr(ratelimit.time, 'sleep', clock.sleep)
+    return clock
+
+
+def test_request_cost_counts_locations_variables_and_days():
+    assert ratelimit.request_cost(URL) == 2
+    many = "https://api.open-meteo.com/v1/forecast?latitude=1&longitude=3&hourly=" + ",".join(f"v{i}" for i in range(20)) + "&forecast_days=28"
+    assert ratelimit.request_cost(many) == 4
+    assert ratelimit.request_cost("http://localhost:9000/api") == 1
+
+
+def test_acquire_waits_for_the_bucket_to_refill(clock):
+    for _ in range(5):
+        ratelimit.acquire(URL)
+    assert clock.now == 1_700_000_000.0
+    assert ratelimit.remaining()['minute'] == 0
+    # 2 tokens refill in 12 seconds at 10 a minute
+    ratelimit.acquire(URL)
+    assert clock.now == pytest.approx(1_700_000_012.0)
+    assert ratelimit.remaining()['hour'] == 30 - 12
+
+
+def test_acquire_raises_once_the_hour_is_used_up(clock):
+    with pytest.raises(ratelimit.BudgetExceeded):
+        for _ in range(16):
+            ratelimit.acquire(URL)
+    assert ratelimit.remaining()['hour'] == 0
+
+
+def test_acquire_gives_up_on_a_long_wait(clock, monkeypatch):
+    monkeypatch.setenv('RATE_LIMIT_MAX_WAIT', '5')
+    for _ in range(5):
+        ratelimit.acquire(URL)
+    with pytest.raises(ratelimit.BudgetExceeded):
+        ratelimit.acquire(URL)
+
+
+def test_reserved_calls_never_overrun_the_budget(clock):
+    reserved = 0
+    for _ in range(20):
+        try:
+            ratelimit.reserve(URL)
+            reserved += 1
+        except ratelimit.BudgetExceeded:
+            pass
+    assert reserved == 15
+    # A reserved call only takes from the per-minute bucket
+    ratelimit.acquire(URL, reserved=True)
+    assert ratelimit.remaining() == {'minute': 8, 'hour': 0, 'day': 10}
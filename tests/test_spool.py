@@ -0,0 +1,118 @@
+import os
+
+from influxdb_client.rest import ApiException
+
+from ingest import spool as spool_module
+from ingest.spool import Spool, CORRUPT, INFLIGHT, PENDING, REJECTED
+
+
+class FakeWriteApi:
+    """Collects the points written, fails the writes listed in `fail` (by call number) with `error`."""
+
+    def __init__(self, fail=(), error=None):
+        self.fail = set(fail)
+        self.error = error or ConnectionError("InfluxDB is down")
+        self.calls = 0
+        self.written = []
+
+    def write(self, bucket, org, batch, write_precision='s'):
+        self.calls += 1
+        if self.calls in self.fail:
+            raise self.error
+        self.written.extend(batch)
+
+
+def pending(spool, records):
+    path = spool.append(records, bucket='b', org='o', write_precision='s')
+    spool.keep(path)
+    return path[:-len(INFLIGHT)] + PENDING
+
+
+def test_drain_replays_oldest_first(tmp_path):
+    spool = Spool(directory=str(tmp_path))
+    for i in range(12):
+        pending(spool, [f"m v={i} {i}"])
+    write_api = FakeWriteApi()
+    assert spool.drain(write_api) == 12
+    # The sequence number orders the segments, not their names as strings
+    assert write_api.written == [f"m v={i} {i}" for i in range(12)]
+    assert os.listdir(tmp_path) == ['sequence']
+    assert (spool.used, spool.count) == (0, 0)
+
+
+def test_make_room_drops_the_oldest_segments(tmp_path):
+    spool = Spool(directory=str(tmp_path))
+    first = pending(spool, ["m v=1 1"])
+    size = spool.used
+    spool.max_bytes = size * 2
+    second = pending(spool, ["m v=2 2"])
+    third = pending(spool, ["m v=3 3"])
+    assert not os.path.exists(first)
+    assert os.path.exists(second) and os.path.exists(third)
+    assert (spool.used, spool.count) == (size * 2, 2)
+
+
+def test_tally_is_read_once_from_disk(tmp_path):
+    spool = Spool(directory=str(tmp_path))
+    pending(spool, ["m v=1 1"])
+    spool.done(spool.append(["m v=2 2"], bucket='b', org='o', write_precision='s'))
+    reopened = Spool(directory=str(tmp_path))
+    assert spool.count == 1
+    assert (reopened.used, reopened.count) == (spool.used, spool.count)
+
+
+def test_corrupt_segment_is_set_aside(tmp_path):
+    spool = Spool(directory=str(tmp_path))
+    bad = pending(spool, ["m v=1 1"])
+    pending(spool, ["m v=2 2"])
+    with open(bad, 'r+b') as file:
+        file.seek(-1, os.SEEK_END)
+        file.write(b"\xff")
+    write_api = FakeWriteApi()
+    assert spool.drain(write_api) == 1
+    assert write_api.written == ["m v=2 2"]
+    assert os.path.exists(bad + CORRUPT)
+
+
+def test_drain_stops_while_influx_is_down(tmp_path, monkeypatch):
+    monkeypatch.setenv('INFLUX_WRITE_RETRIES', '0')
+    spool = Spool(directory=str(tmp_path))
+    first = pending(spool, ["m v=1 1"])
+    second = pending(spool, ["m v=2 2"])
+    assert spool.drain(FakeWriteApi(fail={1})) == 0
+    assert os.path.exists(first) and os.path.exists(second)
+
+
+def test_write_spooled_keeps_failed_records(tmp_path, monkeypatch):
+    monkeypatch.setenv('INFLUX_WRITE_RETRIES', '0')
+    spool = Spool(directory=str(tmp_path))
+    assert spool_module.write_spooled(spool, FakeWriteApi(fail={1}), 'b', 'o', ["m v=1 1"]) is False
+    assert spool.count == 1 and spool.down_until > 0
+    # Straight to the spool while InfluxDB counts as down
+    write_api = FakeWriteApi()
+    assert spool_module.write_spooled(spool, write_api, 'b', 'o', ["m v=2 2"]) is False
+    assert write_api.calls == 0
+
+
+def test_rejected_segment_does_not_block_the_drain(tmp_path):
+    spool = Spool(directory=str(tmp_path))
+    bad = pending(spool, ["m v=bad"])
+    pending(spool, ["m v=2 2"])
+    spool.down_until = float('inf')
+    write_api = FakeWriteApi(fail={1}, error=ApiException(status=400, reason="unable to parse"))
+    assert spool.drain(write_api) == 1
+    assert write_api.written == ["m v=2 2"]
+    assert os.path.exists(bad + REJECTED)
+    # Everything pending was replayed, InfluxDB is up
+    assert spool.down_until == 0
+
+
+def test_write_spooled_sets_rejected_records_aside(tmp_path):
+    spool = Spool(directory=str(tmp_path))
+    write_api = FakeWriteApi(fail={1}, error=ApiException(status=404, reason="bucket not found"))
+    assert spool_module.write_spooled(spool, write_api, 'b', 'o', ["m v=1 1"]) is False
+    # Not retried, not replayed, and InfluxDB does not count as down
+    assert write_api.calls == 1
+    assert spool.down_until == 0
+    assert [name for name in os.listdir(tmp_path) if name.endswith(REJECTED)]
+    assert spool.drain(FakeWriteApi()) == 0
@@ -0,0 +1,55 @@
+import os
+
+from influxdb_client.rest import ApiException
+
+from ingest.spool import Spool, PENDING, REJECTED
+from ingest.writer import BatchWriter
+from tests.test_spool import FakeWriteApi
+
+
+class RejectingWriteApi(FakeWriteApi):
+    """Rejects every batch that holds a line without a timestamp."""
+
+    def write(self, bucket, org, batch, write_precision='s'):
+        self.calls += 1
+        if any(len(line.split(' ')) < 3 for line in batch):
+            raise ApiException(status=400, reason="unable to parse")
+        self.written.extend(batch)
+
+
+def spooled(directory, suffix):
+    return [name for name in os.listdir(directory) if name.endswith(suffix)]
+
+
+def test_submits_are_batched_and_nothing_is_spooled(tmp_path):
+    write_api = FakeWriteApi()
+    writer = BatchWriter(write_api, 'b', 'o', Spool(directory=str(tmp_path)), batch_size=100, flush_interval=5)
+    writes = [writer.submit([f"m v={i} {i}"]) for i in range(10)]
+    assert writer.close(timeout=10)
+    assert [write.written for write in writes] == [True] * 10
+    assert write_api.written == [f"m v={i} {i}" for i in range(10)]
+    assert write_api.calls == 1
+    assert os.listdir(tmp_path) == []
+
+
+def test_failed_batch_is_spooled_by_the_writer(tmp_path, monkeypatch):
+    monkeypatch.setenv('INFLUX_WRITE_RETRIES', '0')
+    spool = Spool(directory=str(tmp_path))
+    writer = BatchWriter(FakeWriteApi(fail={1}), 'b', 'o', spool, batch_size=100, flush_interval=5)
+    writes = [writer.submit([f"m v={i} {i}"]) for i in range(3)]
+    assert writer.close(timeout=10)
+    assert [write.written for write in writes] == [False] * 3
+    assert len(spooled(tmp_path, PENDING)) == 3
+    assert spool.down_until > 0
+
+
+def test_rejected_submit_is_set_aside_alone(tmp_path):
+    write_api = RejectingWriteApi()
+    writer = BatchWriter(write_api, 'b', 'o', Spool(directory=str(tmp_path)), batch_size=100, flush_interval=5)
+    good = writer.submit(["m v=1 1"])
+    bad = writer.submit(["m v=2"])
+    assert writer.close(timeout=10)
+    assert (good.written, bad.written) == (True, False)
+    assert write_api.written == ["m v=1 1"]
+    assert len(spooled(tmp_path, REJECTED)) == 1
+    assert not spooled(tmp_path, PENDING)